@@ -1,29 +1,95 @@
 import argparse
+import bisect
+import json
+import mmap
 import re
 import os
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 
 class Parser:
     def __init__(self, filepath):
-        with open(filepath, "r") as f:
-            self.lines = f.readlines()
-        self._clean_lines()
-
-    def _clean_lines(self):
-        self.lines = [re.sub(r"\s*//.*$", "", line.strip()) for line in self.lines]
-        self.lines = [line for line in self.lines if line]
+        with open(filepath, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buf = b""
+        self.offsets = self._index_lines()
+        self.num_lines = len(self.offsets) - 1
+        self.cursor, self.current = self._seek(0)
+        self.lookahead = None
+
+    def _index_lines(self):
+        """
+        Byte offset at which each line starts, followed by the end of the file.
+        """
+        offsets = array("Q", [0])
+        offsets.extend(m.end() for m in re.finditer(rb"\n", self.buf))
+        offsets.append(len(self.buf))
+        return offsets
+
+    def _clean_line(self, i: int) -> str:
+        line = self.buf[self.offsets[i] : self.offsets[i + 1]].decode()
+        return line.partition("//")[0].strip()
+
+    def _seek(self, i: int):
+        """
+        Returns (index, text) of the first line at or after i holding a
+        command, or (None, None) if there is none.
+        """
+        while i < self.num_lines:
+            line = self._clean_line(i)
+            if line:
+                return i, line
+            i += 1
+        return None, None
 
     @property
     def cmd(self):
-        return self.lines[0]
+        return self.current
+
+    @property
+    def hasCommands(self) -> bool:
+        """
+        False for a source holding nothing but blank lines and comments.
+        """
+        return self.cursor is not None
 
     @property
     def hasMoreCommands(self) -> bool:
-        return len(self.lines) > 1
+        if not self.hasCommands:
+            return False
+        if self.lookahead is None:
+            self.lookahead = self._seek(self.cursor + 1)
+        return self.lookahead[0] is not None
 
     def advance(self):
         if self.hasMoreCommands:
-            self.lines.pop(0)
+            self.cursor, self.current = self.lookahead
+            self.lookahead = None
+
+    def commands(self):
+        """
+        Yields the remaining commands, advancing the parser through them.
+        """
+        if not self.hasCommands:
+            return
+        while True:
+            yield self.cmd
+            if not self.hasMoreCommands:
+                break
+            self.advance()
+
+    def numbered_commands(self):
+        """
+        Yields (line number, command) for the remaining commands, counting lines
+        from 1, advancing the parser through them.
+        """
+        for cmd in self.commands():
+            yield self.cursor + 1, cmd
 
     @property
     def commandType(self) -> str:
@@ -44,19 +110,23 @@ class Parser:
         elif self.commandType == "L_COMMAND":
             return self.cmd[1:-1]
 
-    def _split(self):
-        assert self.commandType == "C_COMMAND"
-        if ";" in self.cmd:
-            dc, j = self.cmd.split(";")
-            if "=" in self.cmd:
+    @staticmethod
+    def split_c_command(cmd: str):
+        if ";" in cmd:
+            dc, j = cmd.split(";")
+            if "=" in cmd:
                 d, c = dc.split("=")
             else:
                 d, c = "null", dc
         else:
-            d, c = self.cmd.split("=")
+            d, c = cmd.split("=")
             j = "null"
         return d, c, j
 
+    def _split(self):
+        assert self.commandType == "C_COMMAND"
+        return Parser.split_c_command(self.cmd)
+
     @property
     def dest(self) -> str:
         assert self.commandType == "C_COMMAND"
@@ -73,6 +143,30 @@ class Parser:
         return self._split()[2]
 
 
+class LineParser(Parser):
+    """
+    Parser over lines already held in memory, e.g. the output of peephole().
+    """
+
+    def __init__(self, lines):
+        self.lines = [line.partition("//")[0].strip() for line in lines]
+        self.num_lines = len(self.lines)
+        self.cursor, self.current = self._seek(0)
+        self.lookahead = None
+
+    def _clean_line(self, i: int) -> str:
+        return self.lines[i]
+
+
+def open_parser(source) -> Parser:
+    """
+    Parser over a file if source is a path, otherwise over source's lines.
+    """
+    if isinstance(source, str):
+        return Parser(source)
+    return LineParser(source)
+
+
 class Code:
     dest_table = {
         "null": "000",
@@ -138,6 +232,61 @@ class Code:
         s = int(s[1:])
         return f"{bin(s)[2:]:0>16}"
 
+    # integer-valued counterparts of the tables above, for encoding straight
+    # into 16-bit words
+    dest_bits = {k: int(v, 2) for k, v in dest_table.items()}
+    comp_bits = {k: int(v, 2) for k, v in comp_table.items()}
+    comp_bits.update(
+        {k: 1 << 6 | int(v, 2) for k, v in comp_table_m.items() if "M" in k}
+    )
+    jump_bits = {k: int(v, 2) for k, v in jump_table.items()}
+
+    @staticmethod
+    def C_word(dest: str, comp: str, jump: str) -> int:
+        return (
+            0b111 << 13
+            | Code.comp_bits[comp] << 6
+            | Code.dest_bits[dest] << 3
+            | Code.jump_bits[jump]
+        )
+
+    # every dest=comp;jump spelling mapped to its word, built on first use
+    c_words = None
+
+    @staticmethod
+    def _build_c_words() -> dict:
+        words = dict()
+        for comp in Code.comp_bits:
+            for dest in Code.dest_bits:
+                for jump in Code.jump_bits:
+                    if dest == "null" and jump == "null":
+                        continue
+                    elif dest == "null":
+                        key = f"{comp};{jump}"
+                    elif jump == "null":
+                        key = f"{dest}={comp}"
+                    else:
+                        key = f"{dest}={comp};{jump}"
+                    words[key] = Code.C_word(dest, comp, jump)
+        return words
+
+    @staticmethod
+    def all_c_words() -> dict:
+        if Code.c_words is None:
+            Code.c_words = Code._build_c_words()
+        return Code.c_words
+
+    @staticmethod
+    def C_line(cmd: str) -> int:
+        """
+        Encodes the full text of a C-command with a single lookup, falling back
+        to splitting it into fields for unusual spellings such as "null=D".
+        """
+        try:
+            return Code.all_c_words()[cmd]
+        except KeyError:
+            return Code.C_word(*Parser.split_c_command(cmd))
+
 
 class SymbolTable:
     def __init__(self, table=None):
@@ -173,7 +322,9 @@ def initialize():
 
 
 def pass1(filepath, table):
-    p = Parser(filepath)
+    p = open_parser(filepath)
+    if not p.hasCommands:
+        return table
 
     counter = 0
     while True:
@@ -190,13 +341,16 @@ def pass1(filepath, table):
 
 
 def pass2(filepath, table):
-    p = Parser(filepath)
+    p = open_parser(filepath)
 
-    res = ""
+    res = array("H")
+    if not p.hasCommands:
+        return res
     available_address = 16
     while True:
         cmd = p.cmd
-        if p.commandType == "A_COMMAND":
+        command_type = p.commandType
+        if command_type == "A_COMMAND":
             try:
                 var = cmd[1:]
                 _ = int(var)
@@ -205,32 +359,613 @@ def pass2(filepath, table):
                     table.addEntry(symbol=var, address=available_address)
                     available_address += 1
                 cmd = "@" + str(table.getAddress(var))
-            res += Code.A(cmd)
-        elif p.commandType == "C_COMMAND":
-            dest, comp, jump = p.dest, p.comp, p.jump
-            res += "111" + Code.comp(comp) + Code.dest(dest) + Code.jump(jump)
+            res.append(int(cmd[1:]))
+        elif command_type == "C_COMMAND":
+            res.append(Code.C_line(cmd))
+
+        if p.hasMoreCommands:
+            p.advance()
+        else:
+            break
+    return res
+
+
+def _encode_chunk(lines, symbols) -> bytes:
+    """
+    Worker for pass2_parallel: encodes cleaned lines with every symbol known.
+    """
+    res = array("H")
+    for line in lines:
+        if line[0] == "@":
+            var = line[1:]
+            res.append(int(var) if var.isdigit() else symbols[var])
+        elif line[0] != "(":
+            res.append(Code.C_line(line))
+    return res.tobytes()
+
+
+def pass2_parallel(filepath, table, jobs: int):
+    """
+    Same result as pass2, with encoding spread over a pool of jobs processes.
+
+    Variables are the only order-dependent part of pass 2, so a cheap serial
+    scan first assigns their addresses in order of first use. The lines are
+    then split into contiguous chunks, encoded independently and concatenated
+    in order.
+    """
+    lines = list(open_parser(filepath).commands())
+    if not lines:
+        return array("H")
+
+    available_address = 16
+    for line in lines:
+        if line[0] == "@":
+            var = line[1:]
+            if not var.isdigit() and not table.contains(var):
+                table.addEntry(symbol=var, address=available_address)
+                available_address += 1
+
+    size = -(-len(lines) // jobs)
+    chunks = [lines[i : i + size] for i in range(0, len(lines), size)]
+    res = array("H")
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for part in pool.map(_encode_chunk, chunks, repeat(table.table)):
+            res.frombytes(part)
+    return res
+
+
+def assemble(filepath, table):
+    """
+    Single-pass alternative to pass1 + pass2.
+
+    Instructions are encoded as they are scanned. A-commands that refer to a
+    symbol not yet in the table are left as placeholders and backpatched once
+    all labels are known; whatever is still unknown at that point is a
+    variable, allocated from address 16 in order of first use.
+    """
+    p = open_parser(filepath)
+
+    res = array("H")
+    if not p.hasCommands:
+        return res
+    forward_refs = dict()
+    while True:
+        cmd = p.cmd
+        command_type = p.commandType
+        if command_type == "A_COMMAND":
+            var = cmd[1:]
+            if var.isdigit():
+                res.append(int(var))
+            elif table.contains(var):
+                res.append(table.getAddress(var))
+            else:
+                forward_refs.setdefault(var, []).append(len(res))
+                res.append(0)
+        elif command_type == "C_COMMAND":
+            res.append(Code.C_line(cmd))
+        elif command_type == "L_COMMAND":
+            table.addEntry(symbol=cmd[1:-1], address=len(res))
 
         if p.hasMoreCommands:
-            if res[-1] != "\n":
-                res += "\n"
             p.advance()
         else:
             break
+
+    available_address = 16
+    for var, indices in forward_refs.items():
+        if not table.contains(var):
+            table.addEntry(symbol=var, address=available_address)
+            available_address += 1
+        address = table.getAddress(var)
+        for i in indices:
+            res[i] = address
     return res
 
 
+def assemble_source(source, optimize=False):
+    """
+    Assembles a program held in memory, without touching disk.
+
+    source is either assembly text or an iterable of lines, e.g. a
+    CodeWriter's output. Returns the encoded words and the final SymbolTable.
+    """
+    lines = source.splitlines() if isinstance(source, str) else list(source)
+    if optimize:
+        lines, _, _ = peephole(LineParser(lines).commands())
+
+    table = initialize()
+    res = assemble(filepath=lines, table=table)
+    return res, table
+
+
+def assemble_object(filepath) -> dict:
+    """
+    Assembles a single module into a relocatable object, to be combined with
+    others by link.py.
+
+    - code: encoded words, laid out as if the module started at address 0
+    - labels: every label the module defines, as an offset into code
+    - relocations: indices of words holding one of the module's own label
+      offsets, which need the module's base address added when linked
+    - references: symbols the module uses but does not define, each with the
+      indices of the words that need its address. A module cannot tell a label
+      defined elsewhere from a variable, so whatever the linker does not find
+      among the other modules' labels becomes a variable.
+    """
+    table = initialize()
+    p = open_parser(filepath)
+
+    code = array("H")
+    labels = dict()
+    references = dict()
+    while p.hasCommands:
+        cmd = p.cmd
+        command_type = p.commandType
+        if command_type == "A_COMMAND":
+            var = cmd[1:]
+            if var.isdigit():
+                code.append(int(var))
+            elif table.contains(var):
+                code.append(table.getAddress(var))
+            else:
+                references.setdefault(var, []).append(len(code))
+                code.append(0)
+        elif command_type == "C_COMMAND":
+            code.append(Code.C_line(cmd))
+        elif command_type == "L_COMMAND":
+            labels[cmd[1:-1]] = len(code)
+
+        if p.hasMoreCommands:
+            p.advance()
+        else:
+            break
+
+    relocations = []
+    for label, offset in labels.items():
+        for i in references.pop(label, []):
+            code[i] = offset
+            relocations.append(i)
+    relocations.sort()
+
+    return {
+        "code": code.tolist(),
+        "labels": labels,
+        "relocations": relocations,
+        "references": references,
+    }
+
+
+def source_map(filepath, table, origins=None) -> dict:
+    """
+    Sidecar map for a program assembled from filepath with the final table.
+    When filepath is a listing rewritten in memory, origins holds the source
+    line of each of its lines, as returned by peephole() and optimize_flow().
+
+    - lines: lines[address] is the 1-based source line of that ROM word
+    - label_addresses, label_names: labels sorted by address, so label_at()
+      can find the label a ROM address falls under by bisection
+    - variables: the address assigned to each variable
+    """
+    p = open_parser(filepath)
+
+    lines = []
+    labels = []
+    while p.hasCommands:
+        command_type = p.commandType
+        if command_type in ["A_COMMAND", "C_COMMAND"]:
+            lines.append(p.cursor + 1 if origins is None else origins[p.cursor])
+        elif command_type == "L_COMMAND":
+            labels.append((len(lines), p.cmd[1:-1]))
+        if p.hasMoreCommands:
+            p.advance()
+        else:
+            break
+    labels.sort()
+
+    predefined = initialize()
+    label_names = {name for _, name in labels}
+    variables = {
+        symbol: address
+        for symbol, address in table.table.items()
+        if symbol not in label_names and not predefined.contains(symbol)
+    }
+    return {
+        "lines": lines,
+        "label_addresses": [address for address, _ in labels],
+        "label_names": [name for _, name in labels],
+        "variables": variables,
+    }
+
+
+def label_at(smap: dict, address: int):
+    """
+    Name of the closest label at or before a ROM address, or None.
+    """
+    i = bisect.bisect_right(smap["label_addresses"], address) - 1
+    return smap["label_names"][i] if i >= 0 else None
+
+
+def _c_fields(line: str):
+    """
+    (dest, comp, jump) of a C-command, or None for A-commands and labels.
+    """
+    if line[0] in "@(":
+        return None
+    return Parser.split_c_command(line)
+
+
+def _jumps_to_numeric_address(lines) -> bool:
+    """
+    Whether cleaned assembly jumps to a ROM address written as a number, which
+    moving any code would break. A number loaded as data and jumped to later
+    through RAM, such as a hand-written return address, looks like any other
+    constant and is not detected.
+    """
+    address = None
+    for line in lines:
+        if line[0] == "@":
+            address = line[1:]
+        elif line[0] != "(":
+            dest, _, jump = Parser.split_c_command(line)
+            if jump != "null" and address is not None and address.isdigit():
+                return True
+            if "A" in dest:
+                address = None
+    return False
+
+
+def _merge_address_load(window):
+    # M=x / A=M -> AM=x
+    fields = _c_fields(window[0])
+    if window[1] == "A=M" and fields and fields[0] in ("M", "MD"):
+        dest, comp, jump = fields
+        if jump == "null":
+            return [f"A{dest}={comp}"]
+
+
+def _repeated_address(window):
+    # @x / <C-command leaving A alone> / @x -> @x / <C-command>
+    if window[0][0] == "@" and window[0] == window[2]:
+        fields = _c_fields(window[1])
+        if fields and "A" not in fields[0] and fields[2] == "null":
+            return window[:2]
+
+
+def _dead_address(window):
+    # @x / @y -> @y
+    if window[0][0] == "@" and window[1][0] == "@":
+        return window[1:]
+
+
+def _cancelling_updates(window):
+    # M=M+1 / M=M-1 -> nothing, and vice versa
+    if tuple(window) in (("M=M+1", "M=M-1"), ("M=M-1", "M=M+1")):
+        return []
+
+
+def _redundant_copy(window):
+    # M=D / D=M -> M=D, and vice versa
+    if tuple(window) in (("M=D", "D=M"), ("D=M", "M=D")):
+        return window[:1]
+
+
+# (window size, rule) pairs; a rule returns the replacement for the window, or
+# None if it does not apply. Every rule is exact for any register and memory
+# state, and a window never spans a label, so rewrites are invisible to code
+# that jumps to any of the program's labels.
+PEEPHOLE_RULES = [
+    (2, _merge_address_load),
+    (3, _repeated_address),
+    (2, _dead_address),
+    (2, _cancelling_updates),
+    (2, _redundant_copy),
+]
+
+
+def _kept_origins(window, replacement, origins):
+    # every rule keeps or rewrites either the start or the end of its window
+    n = len(replacement)
+    if n and replacement != window[:n] and replacement == window[-n:]:
+        return origins[-n:]
+    return origins[:n]
+
+
+def peephole(lines, origins=None):
+    """
+    Applies PEEPHOLE_RULES to cleaned assembly until none of them match.
+
+    Rewriting happens at the end of the output as each line is appended, so a
+    rewrite that exposes a new match is picked up straight away. Code that
+    computes ROM addresses rather than naming labels would be broken by the
+    shift.
+
+    origins optionally holds the source line of each of lines; a rewritten
+    instruction keeps that of the instruction it stands in for. Returns the
+    rewritten lines, the number of instructions removed and their origins, or
+    None if none were given. A program that jumps to a numeric ROM address is
+    returned unchanged.
+    """
+    lines = list(lines)
+    if _jumps_to_numeric_address(lines):
+        return lines, 0, None if origins is None else list(origins)
+
+    res = []
+    res_origins = []
+    removed = 0
+    for line, origin in zip(lines, repeat(None) if origins is None else origins):
+        res.append(line)
+        res_origins.append(origin)
+        changed = True
+        while changed:
+            changed = False
+            for width, rule in PEEPHOLE_RULES:
+                window = res[-width:]
+                if len(window) < width or any(w[0] == "(" for w in window):
+                    continue
+                replacement = rule(window)
+                if replacement is not None:
+                    res_origins[-width:] = _kept_origins(
+                        window, replacement, res_origins[-width:]
+                    )
+                    res[-width:] = replacement
+                    removed += width - len(replacement)
+                    changed = True
+                    break
+    return res, removed, None if origins is None else res_origins
+
+
+class BasicBlock:
+    """straight-line run of instructions, entered only at its labels"""
+
+    def __init__(self):
+        self.labels = []
+        self.lines = []
+        self.origins = []
+
+    def _jump(self):
+        """
+        (dest, comp, jump) of the block's final instruction if it jumps.
+        """
+        fields = _c_fields(self.lines[-1]) if self.lines else None
+        if fields and fields[2] != "null":
+            return fields
+
+    def target(self, label_blocks: dict):
+        """
+        Label the block's final instruction jumps to, or None if it does not
+        jump or jumps through an address computed at run time.
+        """
+        fields = self._jump()
+        if fields is None or len(self.lines) < 2 or self.lines[-2][0] != "@":
+            return None
+        label = self.lines[-2][1:]
+        if label in label_blocks:
+            return label
+
+    @property
+    def falls_through(self) -> bool:
+        fields = self._jump()
+        return fields is None or fields[2] != "JMP"
+
+
+def basic_blocks(lines, origins=None):
+    blocks = [BasicBlock()]
+    for line, origin in zip(lines, repeat(None) if origins is None else origins):
+        if line[0] == "(":
+            if blocks[-1].lines:
+                blocks.append(BasicBlock())
+            blocks[-1].labels.append(line[1:-1])
+        else:
+            blocks[-1].lines.append(line)
+            blocks[-1].origins.append(origin)
+            if blocks[-1]._jump():
+                blocks.append(BasicBlock())
+    if not blocks[-1].labels and not blocks[-1].lines:
+        blocks.pop()
+    return blocks
+
+
+def optimize_flow(lines, origins=None):
+    """
+    Threads jump chains and drops code that cannot be reached.
+
+    A jump to a block that does nothing but jump unconditionally to another
+    label is retargeted to the end of the chain. Blocks are then kept only if
+    they are reachable from the start of the program by falling through, by a
+    jump to a label, or through a label whose address is loaded as data by
+    reachable code (return addresses, which come back via an indirect jump).
+
+    origins optionally holds the source line of each of lines. Returns the
+    rewritten lines, the number of instructions removed, the number of jumps
+    retargeted and the origins of the rewritten lines, or None if none were
+    given. A program that jumps to a numeric ROM address is returned
+    unchanged, since moving any code would break it; see
+    _jumps_to_numeric_address for what this cannot detect.
+    """
+    lines = list(lines)
+    if _jumps_to_numeric_address(lines):
+        return lines, 0, 0, origins
+    blocks = basic_blocks(lines, origins)
+
+    label_blocks = {
+        label: i for i, block in enumerate(blocks) for label in block.labels
+    }
+
+    threaded = 0
+    for i, block in enumerate(blocks):
+        target = block.target(label_blocks)
+        # retargeting would also change the value a comp using A or M reads
+        if target is None or {"A", "M"} & set(block._jump()[1]):
+            continue
+        # and, for a conditional jump, the A seen by the code falling through
+        # unless that code loads A first
+        following = blocks[i + 1].lines[:1] if i + 1 < len(blocks) else []
+        if block.falls_through and following and following[0][0] != "@":
+            continue
+        final, seen = target, {target}
+        while True:
+            hop = blocks[label_blocks[final]]
+            hop_target = hop.target(label_blocks)
+            if len(hop.lines) != 2 or hop.falls_through:
+                break
+            if hop_target is None or hop_target in seen:
+                break
+            final = hop_target
+            seen.add(final)
+        if final != target:
+            block.lines[-2] = f"@{final}"
+            threaded += 1
+
+    reachable = set()
+    pending = [0]
+    while pending:
+        i = pending.pop()
+        if i in reachable or i >= len(blocks):
+            continue
+        reachable.add(i)
+        block = blocks[i]
+        target = block.target(label_blocks)
+        if target is not None:
+            pending.append(label_blocks[target])
+        if block.falls_through:
+            pending.append(i + 1)
+        for j, line in enumerate(block.lines):
+            is_jump_target = target is not None and j == len(block.lines) - 2
+            if line[0] == "@" and line[1:] in label_blocks and not is_jump_target:
+                pending.append(label_blocks[line[1:]])
+
+    res = []
+    res_origins = []
+    removed = 0
+    for i, block in enumerate(blocks):
+        if i in reachable:
+            res += [f"({label})" for label in block.labels] + block.lines
+            res_origins += [None] * len(block.labels) + block.origins
+        else:
+            removed += len(block.lines)
+    return res, removed, threaded, None if origins is None else res_origins
+
+
+def to_text(words) -> str:
+    """
+    Formats encoded words as the text .hack format, one binary word per line.
+    """
+    return "\n".join(f"{word:016b}" for word in words)
+
+
+def to_binary(words) -> bytes:
+    """
+    Packs encoded words into a ROM image of little-endian 16-bit words, which
+    can be loaded directly with array("H").frombytes.
+    """
+    if sys.byteorder == "big":
+        words = array("H", words)
+        words.byteswap()
+    return words.tobytes()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     # Required positional argument
     parser.add_argument("path", help="path to asm file")
-
-    path = parser.parse_args().path
-    saveto = re.sub(r"\.\w+$", r"_me.hack", path)
+    parser.add_argument(
+        "-1",
+        "--single-pass",
+        action="store_true",
+        default=False,
+        help="encode in one pass and backpatch forward label references",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["text", "binary"],
+        default="text",
+        help="write a text .hack file or a packed little-endian ROM image",
+    )
+    parser.add_argument(
+        "-c",
+        "--object",
+        action="store_true",
+        default=False,
+        help="write a relocatable object for link.py instead of a program",
+    )
+    parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        default=False,
+        help="run the peephole optimizer before assembling",
+    )
+    parser.add_argument(
+        "-p",
+        "--prune",
+        action="store_true",
+        default=False,
+        help="thread jump chains and drop unreachable code before assembling",
+    )
+    parser.add_argument(
+        "-m",
+        "--map",
+        action="store_true",
+        default=False,
+        help="also write a source map with label and variable addresses",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes to encode with after the label pass",
+    )
+
+    args = parser.parse_args()
+    if args.object and args.prune:
+        parser.error("--prune needs the whole program and cannot be used with -c")
+
+    path = args.path
+    source, origins = path, None
+    if args.prune or args.optimize:
+        # keep the source line of each instruction for the map
+        numbered = list(Parser(path).numbered_commands())
+        source = [cmd for _, cmd in numbered]
+        origins = [line for line, _ in numbered]
+    if args.prune:
+        source, removed, threaded, origins = optimize_flow(source, origins)
+        print(f"Retargeted {threaded} jumps.")
+        print(f"Removed {removed} unreachable instructions.")
+    if args.optimize:
+        source, removed, origins = peephole(source, origins)
+        print(f"Peephole optimizer removed {removed} instructions.")
+
+    if args.object:
+        saveto = re.sub(r"\.\w+$", r"_me.hobj", path)
+        with open(saveto, "w") as f:
+            json.dump(assemble_object(filepath=source), f)
+        sys.exit()
+
+    if args.format == "binary":
+        saveto = re.sub(r"\.\w+$", r"_me.bin", path)
+    else:
+        saveto = re.sub(r"\.\w+$", r"_me.hack", path)
 
     table = initialize()
-    table = pass1(filepath=path, table=table)
-    res = pass2(filepath=path, table=table)
-
-    with open(saveto, "w") as f:
-        f.write(res)
+    if args.jobs > 1:
+        table = pass1(filepath=source, table=table)
+        res = pass2_parallel(filepath=source, table=table, jobs=args.jobs)
+    elif args.single_pass:
+        res = assemble(filepath=source, table=table)
+    else:
+        table = pass1(filepath=source, table=table)
+        res = pass2(filepath=source, table=table)
+
+    if args.format == "binary":
+        with open(saveto, "wb") as f:
+            f.write(to_binary(res))
+    else:
+        with open(saveto, "w") as f:
+            f.write(to_text(res))
+
+    if args.map:
+        with open(re.sub(r"\.\w+$", r"_me.map", path), "w") as f:
+            json.dump(source_map(filepath=source, table=table, origins=origins), f)
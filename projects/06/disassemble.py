@@ -0,0 +1,188 @@
+import argparse
+import json
+import re
+import sys
+from array import array
+from collections import Counter
+
+from assemble import Code, assemble_source
+
+
+# reverse mappings of the assembler's tables
+dest_text = {v: k for k, v in Code.dest_bits.items()}
+comp_text = {v: k for k, v in Code.comp_bits.items()}
+jump_text = {v: k for k, v in Code.jump_bits.items()}
+c_text = {v: k for k, v in Code.all_c_words().items()}
+
+
+def load_rom(path: str):
+    """
+    Reads a .hack text file or a binary ROM image written by assemble.py.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.strip(b"01\r\n"):
+        return array("H", (int(line, 2) for line in data.split()))
+
+    words = array("H")
+    words.frombytes(data)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+
+def decode(word: int) -> str:
+    if not word & 0x8000:
+        return f"@{word}"
+    try:
+        return c_text[word]
+    except KeyError:
+        pass
+
+    comp = comp_text.get((word >> 6) & 0x7F, "?")
+    dest = dest_text[(word >> 3) & 0b111]
+    jump = jump_text[word & 0b111]
+    if dest == "null":
+        # keep a ";" so that the line still parses as a C-command
+        return f"{comp};{jump}"
+    return f"{dest}={comp}" if jump == "null" else f"{dest}={comp};{jump}"
+
+
+def _is_direct_jump(line: str) -> bool:
+    if line[0] == "@" or ";" not in line:
+        return False
+    comp = line.split(";")[0].split("=")[-1]
+    return "A" not in comp and "M" not in comp and not line.endswith(";null")
+
+
+def disassemble(words, smap=None):
+    """
+    Turns encoded words back into assembly lines.
+
+    smap is a source map written by assemble.py -m. When given, labels are
+    restored at their addresses, an A-command feeding a jump is shown as the
+    label it jumps to, and one loading a variable's address as that variable.
+    Variables are only named in the order the assembler would allocate them
+    again, so that the result assembles to the same words.
+    """
+    lines = [decode(word) for word in words]
+    if smap is None:
+        return lines
+
+    labels = dict()
+    for address, name in zip(smap["label_addresses"], smap["label_names"]):
+        labels.setdefault(address, []).append(name)
+    variables = dict()
+    for name, address in sorted(smap["variables"].items(), key=lambda v: v[1]):
+        if address != 16 + len(variables):
+            break
+        variables[address] = name
+
+    # next address the assembler would give a variable seen for the first time
+    allocated = 16
+    res = []
+    for i, line in enumerate(lines):
+        res += [f"({name})" for name in labels.get(i, [])]
+        if line[0] == "@":
+            address = int(line[1:])
+            following = lines[i + 1] if i + 1 < len(lines) else "@"
+            if address in labels and _is_direct_jump(following):
+                line = f"@{labels[address][0]}"
+            elif address in variables and address <= allocated:
+                line = f"@{variables[address]}"
+                allocated = max(allocated, address + 1)
+        res.append(line)
+    res += [f"({name})" for name in labels.get(len(lines), [])]
+    return res
+
+
+def round_trip(words, smap=None) -> bool:
+    """
+    Whether assembling the disassembly of words gives back the same words.
+    """
+    res, _ = assemble_source(disassemble(words, smap))
+    return res.tolist() == list(words)
+
+
+def histogram(words, top=10, ngram=1) -> dict:
+    """
+    Counts of A- and C-instructions, and the most frequent C-forms and runs
+    of ngram consecutive instructions.
+    """
+    num_c = sum(1 for word in words if word & 0x8000)
+    forms = Counter(decode(word) for word in words if word & 0x8000)
+    res = {
+        "instructions": len(words),
+        "a_instructions": len(words) - num_c,
+        "c_instructions": num_c,
+        "c_forms": forms.most_common(top),
+    }
+    if ngram > 1:
+        # A-command values are collapsed so that runs differing only in the
+        # address or constant they load count as the same sequence
+        lines = ["@" if not word & 0x8000 else decode(word) for word in words]
+        runs = Counter(
+            " / ".join(lines[i : i + ngram]) for i in range(len(lines) - ngram + 1)
+        )
+        res["sequences"] = runs.most_common(top)
+    return res
+
+
+def print_histogram(stats: dict):
+    total = stats["instructions"] or 1
+    print(f"{stats['instructions']} instructions")
+    print(f"  A: {stats['a_instructions']:>8} ({stats['a_instructions'] / total:.1%})")
+    print(f"  C: {stats['c_instructions']:>8} ({stats['c_instructions'] / total:.1%})")
+    print("Most frequent C-forms:")
+    for form, count in stats["c_forms"]:
+        print(f"  {count:>8} ({count / total:.1%})  {form}")
+    if "sequences" in stats:
+        print("Most frequent sequences:")
+        for seq, count in stats["sequences"]:
+            print(f"  {count:>8}  {seq}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Required positional argument
+    parser.add_argument("path", help="path to hack file or binary ROM image")
+    parser.add_argument("-m", "--map", help="source map written by assemble.py -m")
+    parser.add_argument(
+        "-s",
+        "--stats",
+        action="store_true",
+        default=False,
+        help="print an instruction histogram instead of writing assembly",
+    )
+    parser.add_argument(
+        "-c",
+        "--check",
+        action="store_true",
+        default=False,
+        help="check that the disassembly assembles back to the same words",
+    )
+    parser.add_argument("--top", type=int, default=10, help="entries per histogram")
+    parser.add_argument(
+        "--ngram", type=int, default=1, help="also count runs of this many instructions"
+    )
+
+    args = parser.parse_args()
+    path = args.path
+    words = load_rom(path)
+
+    smap = None
+    if args.map is not None:
+        with open(args.map, "r") as f:
+            smap = json.load(f)
+
+    if args.stats:
+        print_histogram(histogram(words, top=args.top, ngram=args.ngram))
+    elif args.check:
+        if not round_trip(words, smap):
+            sys.exit("Disassembly does not assemble back to the same words.")
+        print("Disassembly assembles back to the same words.")
+    else:
+        saveto = re.sub(r"(_me)?\.\w+$", r"_dis.asm", path)
+        with open(saveto, "w") as f:
+            f.writelines(f"{line}\n" for line in disassemble(words, smap))
@@ -0,0 +1,92 @@
+import argparse
+import json
+import re
+from array import array
+
+from assemble import initialize, to_binary, to_text
+
+
+def link(objects):
+    """
+    Combines relocatable objects produced by assemble.py -c into one program,
+    laid out in the order given.
+
+    A module's references to its own labels are already resolved through its
+    relocations, so labels such as the translator's TRUE0 or END may repeat
+    across modules. A reference to another module's label must name exactly
+    one definition. Remaining references are variables, allocated from address
+    16 in order of first use across modules, as if the modules had been
+    assembled as one concatenated file.
+    """
+    table = initialize()
+
+    bases = []
+    exports = dict()
+    base = 0
+    for obj in objects:
+        bases.append(base)
+        for label, offset in obj["labels"].items():
+            # None marks a label defined by more than one module
+            exports[label] = None if label in exports else base + offset
+        base += len(obj["code"])
+
+    res = array("H")
+    available_address = 16
+    for obj, base in zip(objects, bases):
+        code = array("H", obj["code"])
+        for i in obj["relocations"]:
+            code[i] += base
+        for symbol, indices in obj["references"].items():
+            if symbol in exports:
+                address = exports[symbol]
+                if address is None:
+                    raise ValueError(
+                        f"Label {symbol} is defined in more than one module"
+                    )
+            else:
+                if not table.contains(symbol):
+                    table.addEntry(symbol=symbol, address=available_address)
+                    available_address += 1
+                address = table.getAddress(symbol)
+            for i in indices:
+                code[i] = address
+        res.extend(code)
+
+    for label, address in exports.items():
+        if address is not None:
+            table.addEntry(symbol=label, address=address)
+    return res, table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Required positional argument
+    parser.add_argument("paths", nargs="+", help="paths to hobj files, in order")
+    parser.add_argument("-o", "--output", help="path to save the linked program to")
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["text", "binary"],
+        default="text",
+        help="write a text .hack file or a packed little-endian ROM image",
+    )
+
+    args = parser.parse_args()
+    saveto = args.output
+    if saveto is None:
+        ext = "_me.bin" if args.format == "binary" else "_me.hack"
+        saveto = re.sub(r"(_me)?\.\w+$", ext, args.paths[0])
+
+    objects = []
+    for path in args.paths:
+        with open(path, "r") as f:
+            objects.append(json.load(f))
+    res, _ = link(objects)
+
+    if args.format == "binary":
+        with open(saveto, "wb") as f:
+            f.write(to_binary(res))
+    else:
+        with open(saveto, "w") as f:
+            f.write(to_text(res))
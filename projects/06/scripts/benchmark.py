@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+"""times the assembler phases on the bundled programs and on synthetic ones"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from assemble import initialize, pass1, pass2, to_text
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the .hack files in project 5 were written by the course's own assembler;
+# Pong has none, so it is only checked against its label-free twin
+BUNDLED = [
+    ("pong/Pong.asm", "pong/PongL.asm"),
+    ("pong/PongL.asm", None),
+    ("rect/Rect.asm", "../05/Rect.hack"),
+    ("rect/RectL.asm", "../05/Rect.hack"),
+    ("max/Max.asm", "../05/Max.hack"),
+    ("max/MaxL.asm", "../05/Max.hack"),
+    ("add/Add.asm", "../05/Add.hack"),
+]
+C_COMMANDS = [
+    "D=M",
+    "D=A",
+    "M=D",
+    "A=M",
+    "AM=M-1",
+    "M=M+1",
+    "D=D+M",
+    "M=D+M",
+    "D=D-A",
+    "D;JEQ",
+    "D;JGT",
+    "0;JMP",
+]
+
+
+def generate(path: str, path_l: str, num_instructions: int, seed=0):
+    """
+    Writes a synthetic program with labels, variables, comments and blank
+    lines to path, and the same program with every symbol already resolved to
+    path_l, so that the two must assemble to the same words.
+    """
+    rng = random.Random(seed)
+    label_spacing = 20
+    # labels past the 32K ROM limit are defined, but only ones an A-command
+    # can address are referenced
+    num_labels = min(num_instructions, 32768) // label_spacing
+    variables = dict()
+
+    with open(path, "w") as f, open(path_l, "w") as f_l:
+        for address in range(num_instructions):
+            if address % label_spacing == 0:
+                f.write(f"(L{address // label_spacing})\n")
+            if rng.random() < 0.05:
+                f.write("\n// comment\n")
+
+            if rng.random() < 0.5:
+                kind = rng.random()
+                if kind < 0.4 and num_labels:
+                    label = rng.randrange(num_labels)
+                    line, line_l = f"@L{label}", f"@{label * label_spacing}"
+                elif kind < 0.7:
+                    var = f"v{rng.randrange(500)}"
+                    if var not in variables:
+                        variables[var] = 16 + len(variables)
+                    line, line_l = f"@{var}", f"@{variables[var]}"
+                else:
+                    n = rng.randrange(16384)
+                    line, line_l = f"@{n}", f"@{n}"
+            else:
+                line = line_l = rng.choice(C_COMMANDS)
+            f.write(f"{line}\n")
+            f_l.write(f"{line_l}\n")
+
+
+def run_phases(path: str):
+    start = time.perf_counter()
+    table = initialize()
+    t_initialize = time.perf_counter()
+    table = pass1(filepath=path, table=table)
+    t_pass1 = time.perf_counter()
+    res = pass2(filepath=path, table=table)
+    t_pass2 = time.perf_counter()
+    phases = {
+        "initialize": t_initialize - start,
+        "pass1": t_pass1 - t_initialize,
+        "pass2": t_pass2 - t_pass1,
+    }
+    return res, phases
+
+
+def benchmark_file(path: str, reference, repeat: int, memory: bool) -> dict:
+    """
+    reference is a .hack file, or a label-free .asm file whose words the
+    program must reproduce, or None to skip verification. A .hack file checks
+    the encoding; a label-free twin is assembled by this same assembler, so it
+    only checks that symbols resolve to the same addresses.
+    """
+    runs = [run_phases(path) for _ in range(repeat)]
+    res = runs[0][0]
+    phases = {k: min(phases[k] for _, phases in runs) for k in runs[0][1]}
+
+    result = {
+        "instructions": len(res),
+        "phases": phases,
+        "instructions_per_sec": len(res) / sum(phases.values()),
+    }
+
+    if memory:
+        tracemalloc.start()
+        run_phases(path)
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    if reference is not None:
+        if reference.endswith(".hack"):
+            with open(reference, "r") as f:
+                expected = f.read().split()
+            result["verified_against"] = "encoding"
+        else:
+            expected = to_text(run_phases(reference)[0]).split()
+            result["verified_against"] = "symbols"
+        result["verified"] = to_text(res).split() == expected
+    return result
+
+
+def compare(results: dict, baseline: dict):
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["instructions_per_sec"]
+        after = result["instructions_per_sec"]
+        print(
+            f"{name}: {after:,.0f} instructions/sec vs {before:,.0f} "
+            f"({after / before:.2f}x)",
+            file=sys.stderr,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=[100_000, 1_000_000],
+        help="instruction counts of the synthetic programs",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per program")
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        default=False,
+        help="skip the extra traced run that measures peak memory",
+    )
+    parser.add_argument("-o", "--output", help="path to save the JSON report to")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+
+    args = parser.parse_args()
+
+    results = dict()
+    for path, reference in BUNDLED:
+        if reference is None:
+            hack = os.path.join(PROJECT_DIR, path.replace(".asm", ".hack"))
+            reference = hack if os.path.exists(hack) else None
+        else:
+            reference = os.path.join(PROJECT_DIR, reference)
+        print(f"Benchmarking {path}...", file=sys.stderr)
+        results[path] = benchmark_file(
+            os.path.join(PROJECT_DIR, path), reference, args.repeat, not args.no_memory
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = os.path.join(tmp, f"Synthetic{size}.asm")
+            path_l = os.path.join(tmp, f"Synthetic{size}L.asm")
+            generate(path, path_l, size)
+            print(f"Benchmarking {size} synthetic instructions...", file=sys.stderr)
+            results[f"synthetic/{size}"] = benchmark_file(
+                path, path_l, args.repeat, not args.no_memory
+            )
+
+    report = json.dumps(results, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            compare(results, json.load(f))
+
+    if not all(result.get("verified", True) for result in results.values()):
+        sys.exit("Output does not match the reference.")
@@ -1,3 +1,4 @@
+import functools
 import typing as t
 
 
@@ -201,3 +202,37 @@ def pop_temp(index: int):
     res += ["@addr"]
     deref_ptr(res, op="M=D")
     return res
+
+
+push_pop_table = {
+    ("push", "argument"): push_argument,
+    ("push", "local"): push_local,
+    ("push", "static"): push_static,
+    ("push", "constant"): push_constant,
+    ("push", "this"): push_this,
+    ("push", "that"): push_that,
+    ("push", "pointer"): push_pointer,
+    ("push", "temp"): push_temp,
+    ("pop", "argument"): pop_argument,
+    ("pop", "local"): pop_local,
+    ("pop", "static"): pop_static,
+    ("pop", "this"): pop_this,
+    ("pop", "that"): pop_that,
+    ("pop", "pointer"): pop_pointer,
+    ("pop", "temp"): pop_temp,
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def push_pop(
+    command: str, segment: str, index: int, file_name: t.Optional[str] = None
+) -> t.Tuple[str, ...]:
+    """
+    Rendered push/pop snippet. Compiled Jack code reuses the same few hundred
+    forms over and over, so snippets are cached rather than rebuilt; file_name
+    only matters for the static segment.
+    """
+    f = push_pop_table[(command, segment)]
+    if segment == "static":
+        return tuple(f(index, file_name))
+    return tuple(f(index))
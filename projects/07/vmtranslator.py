@@ -1,8 +1,12 @@
 import argparse
+import mmap
+import os
 import re
+from array import array
 from enum import Enum
 
 import helpers as h
+import vmir as ir
 
 
 class C(str, Enum):
@@ -17,50 +21,98 @@ class C(str, Enum):
     CALL = "CALL"
 
 
+COMMAND_TYPES = {
+    **{name: C.ARITHMETIC for name in ir.OPCODES[ir.ADD : ir.NOT + 1]},
+    "push": C.PUSH,
+    "pop": C.POP,
+    "label": C.LABEL,
+    "goto": C.GOTO,
+    "if-goto": C.IF,
+    "function": C.FUNCTION,
+    "return": C.RETURN,
+    "call": C.CALL,
+}
+
+
 class Parser:
     def __init__(self, filepath):
-        with open(filepath, "r") as f:
-            self.lines = f.readlines()
-        self._clean_lines()
-
-    def _clean_lines(self):
-        self.lines = [re.sub(r"\s*//.*$", "", line.strip()) for line in self.lines]
-        self.lines = [line for line in self.lines if line]
+        with open(filepath, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buf = b""
+        self.offsets = self._index_lines()
+        self.cursor, self.current = self._seek(0)
+        self.lookahead = None
+
+    def _index_lines(self):
+        """
+        Byte offset at which each line starts, followed by the end of the file.
+        """
+        offsets = array("Q", [0])
+        offsets.extend(m.end() for m in re.finditer(rb"\n", self.buf))
+        offsets.append(len(self.buf))
+        return offsets
+
+    def _clean_line(self, i: int) -> str:
+        line = self.buf[self.offsets[i] : self.offsets[i + 1]].decode()
+        return line.partition("//")[0].strip()
+
+    def _seek(self, i: int):
+        """
+        Returns (index, text) of the first line at or after i holding a
+        command, or (None, None) if there is none.
+        """
+        while i < len(self.offsets) - 1:
+            line = self._clean_line(i)
+            if line:
+                return i, line
+            i += 1
+        return None, None
 
     @property
     def cmd(self):
-        return self.lines[0]
+        return self.current
 
     @property
     def hasMoreCommands(self) -> bool:
-        return len(self.lines) > 1
+        if self.cursor is None:
+            return False
+        if self.lookahead is None:
+            self.lookahead = self._seek(self.cursor + 1)
+        return self.lookahead[0] is not None
 
     def advance(self):
         if self.hasMoreCommands:
-            self.lines.pop(0)
+            self.cursor, self.current = self.lookahead
+            self.lookahead = None
+
+    def commands(self):
+        """
+        Yields the remaining commands, advancing the parser through them.
+        """
+        if self.cursor is None:
+            return
+        while True:
+            yield self.cmd
+            if not self.hasMoreCommands:
+                break
+            self.advance()
+
+    def program(self):
+        """
+        Encodes the remaining commands, advancing the parser through them.
+        """
+        res = ir.Program()
+        for cmd in self.commands():
+            res.append_words(cmd.split())
+        return res
 
     @property
     def commandType(self) -> str:
-        first_word = self.cmd.split()[0]
-        if first_word in ("add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"):
-            return C.ARITHMETIC
-        elif first_word == "push":
-            return C.PUSH
-        elif first_word == "pop":
-            return C.POP
-        elif first_word == "label":
-            return C.LABEL
-        elif first_word == "goto":
-            return C.GOTO
-        elif first_word == "if-goto":
-            return C.IF
-        elif first_word == "function":
-            return C.FUNCTION
-        elif first_word == "return":
-            return C.RETURN
-        elif first_word == "call":
-            return C.CALL
-        else:
+        try:
+            return COMMAND_TYPES[self.cmd.split(maxsplit=1)[0]]
+        except KeyError:
             raise ValueError
 
     @property
@@ -112,23 +164,30 @@ class CodeWriter:
             "temp",
         )
 
-        try:
-            if segment == "static":
-                f = eval(f"h.{command}_static")
-                self.output += f(index, self.file_name)
-            else:
-                f = eval(f"h.{command}_{segment}")
-                self.output += f(index)
-        except Exception as e:
-            raise e
+        file_name = self.file_name if segment == "static" else None
+        self.output += h.push_pop(command, segment, index, file_name)
 
     def writeLine(self, *args):
-        self.output += [f"// {' '.join(args)}"]
-        if len(args) == 1:
-            self.writeArithmetic(*args)
-        elif len(args) == 3:
-            command, segment, index = args
-            self.writePushPop(command, segment, int(index))
+        program = ir.Program()
+        program.append_words(args)
+        self.writeCommand(program[0], program)
+
+    def writeCommand(self, cmd, program):
+        """
+        Writes one encoded command; program holds the names it refers to.
+        """
+        self.output += [f"// {' '.join(program.words(cmd))}"]
+        op, segment, operand, _ = cmd
+        if op <= ir.NOT:
+            self.writeArithmetic(ir.OPCODES[op])
+        elif op in (ir.PUSH, ir.POP):
+            self.writePushPop(ir.OPCODES[op], ir.SEGMENTS[segment], operand)
+        else:
+            raise ValueError("Command in line not recognized")
+
+    def writeProgram(self, program):
+        for cmd in program:
+            self.writeCommand(cmd, program)
 
     def _finish(self):
         self.output += ["(END)", "@END", "0;JMP"]
@@ -143,17 +202,9 @@ class CodeWriter:
 def main(file_path):
     file_name = re.findall(r"\w+", file_path)[-2]
 
-    p = Parser(file_path)
     cw = CodeWriter()
     cw.setFileName(file_name=file_name)
-
-    while True:
-        cmd = p.cmd.split()
-        cw.writeLine(*cmd)
-        if p.hasMoreCommands:
-            p.advance()
-        else:
-            break
+    cw.writeProgram(Parser(file_path).program())
 
     cw.to_disk(file_path=file_path.replace(".vm", ".asm"))
 
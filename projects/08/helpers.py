@@ -1,3 +1,4 @@
+import functools
 import typing as t
 
 
@@ -89,7 +90,8 @@ def _push_d(res):
 
 
 def push_constant(index: int) -> t.List[str]:
-    res = [f"@{index}", "D=A"]
+    # negative constants only come from the VM peephole pass folding not/neg
+    res = [f"@{index}", "D=A"] if index >= 0 else [f"@{~index}", "D=!A"]
     _push_d(res)
     return res
 
@@ -207,6 +209,123 @@ def pop_temp(index: int):
     return res
 
 
+push_pop_table = {
+    ("push", "argument"): push_argument,
+    ("push", "local"): push_local,
+    ("push", "static"): push_static,
+    ("push", "constant"): push_constant,
+    ("push", "this"): push_this,
+    ("push", "that"): push_that,
+    ("push", "pointer"): push_pointer,
+    ("push", "temp"): push_temp,
+    ("pop", "argument"): pop_argument,
+    ("pop", "local"): pop_local,
+    ("pop", "static"): pop_static,
+    ("pop", "this"): pop_this,
+    ("pop", "that"): pop_that,
+    ("pop", "pointer"): pop_pointer,
+    ("pop", "temp"): pop_temp,
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def push_pop(
+    command: str, segment: str, index: int, file_name: t.Optional[str] = None
+) -> t.Tuple[str, ...]:
+    """
+    Rendered push/pop snippet. Compiled Jack code reuses the same few hundred
+    forms over and over, so snippets are cached rather than rebuilt; file_name
+    only matters for the static segment.
+    """
+    f = push_pop_table[(command, segment)]
+    if segment == "static":
+        return tuple(f(index, file_name))
+    return tuple(f(index))
+
+
+# With top-of-stack caching the value on top of the stack may be held in D
+# instead of RAM[SP-1]; SP then does not count it. The snippets below work on
+# that representation: the *_d ones expect the cached value in D.
+
+SEGMENT_POINTERS = {"argument": "ARG", "local": "LCL", "this": "THIS", "that": "THAT"}
+
+
+def spill_d() -> t.List[str]:
+    res = []
+    _push_d(res)
+    return res
+
+
+def fill_d() -> t.List[str]:
+    return ["@SP", "AM=M-1", "D=M"]
+
+
+def load_to_d(segment: str, index: int, file_name: t.Optional[str] = None):
+    """
+    A push that leaves the value in D rather than storing it on the stack.
+    Other than for constants, A is left holding the value's address.
+    """
+    if segment == "constant":
+        if index in (0, 1):
+            return [f"D={index}"]
+        return [f"@{index}", "D=A"] if index >= 0 else [f"@{~index}", "D=!A"]
+    address = address_a(segment, index, file_name)
+    if address is not None and len(address) <= 4:
+        return address + ["D=M"]
+    return [f"@{index}", "D=A", f"@{SEGMENT_POINTERS[segment]}", "A=D+M", "D=M"]
+
+
+def address_a(segment: str, index: int, file_name: t.Optional[str] = None):
+    """
+    Puts the address of segment[index] in A without touching D, or returns
+    None when that would take more than a few instructions.
+    """
+    if segment == "static":
+        return [f"@{file_name}.{index}"]
+    if segment == "pointer":
+        return [("@THIS", "@THAT")[index]]
+    if segment == "temp":
+        assert index < 8
+        return [f"@{5 + index}"]
+    if index == 0:
+        return [f"@{SEGMENT_POINTERS[segment]}", "A=M"]
+    if index < 8:
+        return [f"@{SEGMENT_POINTERS[segment]}", "A=M+1"] + ["A=A+1"] * (index - 1)
+    return None
+
+
+def store_d(segment: str, index: int, file_name: t.Optional[str] = None):
+    """
+    A pop of the value held in D.
+    """
+    res = address_a(segment, index, file_name)
+    if res is not None:
+        return res + ["M=D"]
+
+    # the address needs D, so park the value in R13 meanwhile
+    base = SEGMENT_POINTERS[segment]
+    res = ["@R13", "M=D", f"@{index}", "D=A", f"@{base}", "D=D+M", "@R14", "M=D"]
+    res += ["@R13", "D=M", "@R14", "A=M", "M=D"]
+    return res
+
+
+def binop_d(command: str) -> t.List[str]:
+    d = {"add": "D+M", "sub": "M-D", "and": "D&M", "or": "D|M"}
+    return ["@SP", "AM=M-1", f"D={d[command]}"]
+
+
+def unop_d(command: str) -> t.List[str]:
+    d = {"neg": "-D", "not": "!D"}
+    return [f"D={d[command]}"]
+
+
+def compare_d(command: str, s=0) -> t.List[str]:
+    d = {"eq": "JEQ", "gt": "JGT", "lt": "JLT"}
+    res = ["@SP", "AM=M-1", "D=M-D", f"@TRUE{s}", f"D;{d[command]}", "D=0"]
+    res += [f"@END{s}", "0;JMP", f"(TRUE{s})", "D=-1", f"(END{s})"]
+    return res
+
+
 def _flabel(label: str, function_name: t.Optional[str]) -> str:
     return f"{label}" if function_name is None else f"{function_name}${label}"
 
@@ -228,6 +347,136 @@ def if_goto_label(label: str, function_name: t.Optional[str] = None):
     return res
 
 
+def if_goto_label_d(label: str, function_name: t.Optional[str] = None):
+    return [f"@{_flabel(label, function_name)}", "D;JNE"]
+
+
+# Fused commands produced by the VM peephole pass in vmtranslator.py
+
+
+def increment(segment: str, index: int, k: int, file_name: t.Optional[str] = None):
+    """
+    inc segment index k: segment[index] += k, leaving the stack alone.
+    """
+    if k == 0:
+        return []
+    address = address_a(segment, index, file_name)
+    if k in (1, -1):
+        if address is None:
+            base = SEGMENT_POINTERS[segment]
+            address = [f"@{index}", "D=A", f"@{base}", "A=D+M"]
+        return address + ["M=M+1" if k > 0 else "M=M-1"]
+
+    res = [f"@{abs(k)}", "D=A"]
+    if address is None:
+        base = SEGMENT_POINTERS[segment]
+        res = [f"@{index}", "D=A", f"@{base}", "D=D+M", "@R13", "M=D"] + res
+        address = ["@R13", "A=M"]
+    return res + address + ["M=D+M" if k > 0 else "M=M-D"]
+
+
+def push_add_constant(k: int) -> t.List[str]:
+    """
+    push-add constant k: adds k to the value on top of the stack.
+    """
+    if k == 0:
+        return []
+    if k in (1, -1):
+        return ["@SP", "A=M-1", "M=M+1" if k > 0 else "M=M-1"]
+    return [f"@{abs(k)}", "D=A", "@SP", "A=M-1", "M=D+M" if k > 0 else "M=M-D"]
+
+
+def push_add_constant_d(k: int) -> t.List[str]:
+    if k == 0:
+        return []
+    if k in (1, -1):
+        return ["D=D+1" if k > 0 else "D=D-1"]
+    return [f"@{abs(k)}", "D=D+A" if k > 0 else "D=D-A"]
+
+
+def move(
+    segment: str,
+    index: int,
+    from_segment: str,
+    from_index: int,
+    file_name: t.Optional[str] = None,
+):
+    """
+    pop-to segment index from_segment from_index: a push immediately popped
+    somewhere else, as a direct load and store that never touches the stack.
+    The shortest of the sequences that apply is used.
+    """
+    load = load_to_d(from_segment, from_index, file_name)
+    address = address_a(segment, index, file_name)
+    candidates = [load + store_d(segment, index, file_name)]
+
+    # -1, 0 and 1 can be stored without going through D
+    if from_segment == "constant" and from_index in (-1, 0, 1):
+        if address is not None:
+            candidates.append(address + [f"M={from_index}"])
+
+    # the load leaves A at the source, from where it can step to a nearby
+    # destination in the same segment
+    if from_segment == segment and segment in (*SEGMENT_POINTERS, "temp"):
+        step = index - from_index
+        steps = ["A=A+1"] * step if step > 0 else ["A=A-1"] * -step
+        candidates.append(load + steps + ["M=D"])
+
+    # a destination whose address needs D is worked out before the load
+    if address is None:
+        base = SEGMENT_POINTERS[segment]
+        res = [f"@{index}", "D=A", f"@{base}", "D=D+M", "@R13", "M=D"]
+        candidates.append(res + load + ["@R13", "A=M", "M=D"])
+
+    return min(candidates, key=len)
+
+
+def store(segment: str, index: int, file_name: t.Optional[str] = None):
+    """
+    store segment index: a pop to an address known at translation time.
+    """
+    return fill_d() + store_d(segment, index, file_name)
+
+
+def if_not_goto_label(label: str, function_name: t.Optional[str] = None):
+    """
+    if-not-goto label: pops a value and jumps unless it is -1 (true).
+    """
+    return fill_d() + if_not_goto_label_d(label, function_name)
+
+
+def if_not_goto_label_d(label: str, function_name: t.Optional[str] = None):
+    return [f"@{_flabel(label, function_name)}", "D+1;JNE"]
+
+
+COMPARE_JUMPS = {
+    "eq": "JEQ",
+    "gt": "JGT",
+    "lt": "JLT",
+    "ne": "JNE",
+    "le": "JLE",
+    "ge": "JGE",
+}
+
+
+def if_compare_goto_label(
+    compare: str, label: str, function_name: t.Optional[str] = None
+):
+    """
+    if-<compare>-goto label: pops y and x and jumps if x <compare> y, without
+    materialising the boolean that compare and if-goto would pass on the stack.
+    """
+    return fill_d() + if_compare_goto_label_d(compare, label, function_name)
+
+
+def if_compare_goto_label_d(
+    compare: str, label: str, function_name: t.Optional[str] = None
+):
+    res = ["@SP", "AM=M-1", "D=M-D"]
+    res += [f"@{_flabel(label, function_name)}", f"D;{COMPARE_JUMPS[compare]}"]
+    return res
+
+
 def call_function(function_name: str, num_args: int, function_call_counter: int):
     RETURN_ADDRESS = f"return-address{function_call_counter}"
     res = []
@@ -270,6 +519,76 @@ def call_function(function_name: str, num_args: int, function_call_counter: int)
     return res
 
 
+CALL_ROUTINE = "VM$CALL"
+RETURN_ROUTINE = "VM$RETURN"
+
+
+def call_via_trampoline(
+    function_name: str, num_args: int, function_call_counter: int
+):
+    """
+    Call site for the shared call routine: the callee goes in R13, nArgs in
+    R14 and the return address in D.
+    """
+    RETURN_ADDRESS = f"return-address{function_call_counter}"
+    res = [f"@{function_name}", "D=A", "@R13", "M=D"]
+    if num_args in (0, 1):
+        res += ["@R14", f"M={num_args}"]
+    else:
+        res += [f"@{num_args}", "D=A", "@R14", "M=D"]
+    res += [f"@{RETURN_ADDRESS}", "D=A"]
+    res += goto_label(label=CALL_ROUTINE)
+    res += assign_label(label=RETURN_ADDRESS)
+    return res
+
+
+def call_routine():
+    """
+    Body shared by every call_via_trampoline site, emitted once per program.
+    """
+    res = assign_label(label=CALL_ROUTINE)
+
+    # push return-address
+    _push_d(res)
+
+    # push LCL, ARG, THIS, THAT
+    for pointer in ("LCL", "ARG", "THIS", "THAT"):
+        res += [f"@{pointer}", "D=M"]
+        _push_d(res)
+
+    # ARG = SP-n-5
+    res += ["@SP", "D=M"]
+    res += ["@R14", "D=D-M"]
+    res += ["@5", "D=D-A"]
+    res += ["@ARG", "M=D"]
+
+    # LCL = SP
+    res += ["@SP", "D=M"]
+    res += ["@LCL", "M=D"]
+
+    # goto called function
+    res += ["@R13", "A=M", "0;JMP"]
+    return res
+
+
+def return_via_trampoline():
+    return goto_label(label=RETURN_ROUTINE)
+
+
+def return_routine():
+    """
+    Body shared by every return_via_trampoline site, emitted once per program.
+    """
+    return assign_label(label=RETURN_ROUTINE) + return_from_function()
+
+
+def count_instructions(lines) -> int:
+    """
+    Number of ROM words taken by lines, which may include labels and comments.
+    """
+    return sum(1 for line in lines if line[0] != "(" and not line.startswith("//"))
+
+
 def declare_function(function_name: str, num_locals: int):
     res = []
     res += assign_label(f"{function_name}")
@@ -278,6 +597,91 @@ def declare_function(function_name: str, num_locals: int):
     return res
 
 
+# Compact zero-filling of locals. push_constant(0) per local costs 7 words and
+# 7 cycles each; the alternatives are
+#
+#   sequence: M=0 stores walking A up the stack, then one SP update; 3n+2
+#             words and cycles up to 3 locals and 2n+5 after that
+#   routine:  an 8-word call site entering a shared loop, which moves SP past
+#             the locals and zeroes them in 6 cycles each; 6n+14 cycles, and
+#             the loop itself takes 12 words once per program
+#
+# The loop is never faster than the sequence, so it only trades cycles for
+# ROM. A function uses it when that still makes it no slower than the plain
+# translation, and when its own site plus the whole loop is smaller than the
+# sequence. That holds from 14 locals on; as any one such site pays for the
+# loop, a program that uses the loop at all is smaller than one that does not.
+
+ZERO_FILL_ROUTINE = "VM$ZERO"
+
+
+def zero_locals(num_locals: int) -> t.List[str]:
+    if num_locals == 0:
+        return []
+    res = ["@SP", "A=M"] + ["M=0", "A=A+1"] * (num_locals - 1) + ["M=0"]
+    if num_locals <= 3:
+        return res + ["@SP"] + ["M=M+1"] * num_locals
+    return res + ["A=A+1", "D=A", "@SP", "M=D"]
+
+
+def zero_locals_via_routine(function_name: str, num_locals: int) -> t.List[str]:
+    """
+    Call site for zero_fill_routine: the return address goes in R14 and the
+    number of locals in D. The function's name keeps the return label unique.
+    """
+    return_address = f"{ZERO_FILL_ROUTINE}${function_name}"
+    res = [f"@{return_address}", "D=A", "@R14", "M=D", f"@{num_locals}", "D=A"]
+    res += goto_label(label=ZERO_FILL_ROUTINE)
+    res += assign_label(label=return_address)
+    return res
+
+
+def zero_fill_routine() -> t.List[str]:
+    """
+    Pushes D zeroes and returns to R14: SP is moved past them first, and the
+    loop then counts D up from -n, zeroing SP+D.
+    """
+    loop = f"{ZERO_FILL_ROUTINE}.LOOP"
+    res = assign_label(label=ZERO_FILL_ROUTINE)
+    res += ["@SP", "M=D+M", "D=-D"]
+    res += assign_label(label=loop)
+    res += ["@SP", "A=D+M", "M=0", "D=D+1", f"@{loop}", "D;JLT"]
+    res += ["@R14", "A=M", "0;JMP"]
+    return res
+
+
+def zero_fill_costs(num_locals: int) -> t.Dict[str, t.Tuple[int, int]]:
+    """
+    (words, cycles) at each function entry of each way to zero num_locals
+    locals, per the model above; the routine's own words are not included.
+    """
+    n = num_locals
+    sequence = 3 * n + 2 if n <= 3 else 2 * n + 5
+    return {
+        "push": (7 * n, 7 * n),
+        "sequence": (sequence, sequence),
+        "routine": (8, 6 * n + 14),
+    }
+
+
+def zero_fill_strategy(num_locals: int) -> str:
+    costs = zero_fill_costs(num_locals)
+    words, cycles = costs["routine"]
+    words += count_instructions(zero_fill_routine())
+    if cycles <= costs["push"][1] and words < costs["sequence"][0]:
+        return "routine"
+    return "sequence"
+
+
+def declare_function_compact(function_name: str, num_locals: int):
+    res = assign_label(f"{function_name}")
+    if num_locals == 0:
+        return res
+    if zero_fill_strategy(num_locals) == "routine":
+        return res + zero_locals_via_routine(function_name, num_locals)
+    return res + zero_locals(num_locals)
+
+
 def return_from_function():
     FRAME = "FRAME"
     RET = "RET"
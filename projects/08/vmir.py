@@ -0,0 +1,179 @@
+"""
+Compact form of parsed VM commands. A command is a tuple of four ints,
+(opcode, segment, operand, symbol), and a Program keeps them in parallel arrays
+with label and function names interned, so that later stages compare small
+ints instead of splitting and matching strings.
+"""
+
+import typing as t
+from array import array
+
+
+OPCODES = [
+    "add",
+    "sub",
+    "neg",
+    "eq",
+    "gt",
+    "lt",
+    "and",
+    "or",
+    "not",
+    "push",
+    "pop",
+    "label",
+    "goto",
+    "if-goto",
+    "function",
+    "call",
+    "return",
+    # fused commands written by the VM peephole pass
+    "inc",
+    "push-add",
+    "pop-to",
+    "store",
+    "if-not-goto",
+    "if-eq-goto",
+    "if-gt-goto",
+    "if-lt-goto",
+    "if-ne-goto",
+    "if-le-goto",
+    "if-ge-goto",
+]
+OPCODE_IDS = {name: i for i, name in enumerate(OPCODES)}
+
+(ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT) = range(9)
+(PUSH, POP, LABEL, GOTO, IF_GOTO, FUNCTION, CALL, RETURN) = range(9, 17)
+(INC, PUSH_ADD, POP_TO, STORE, IF_NOT_GOTO) = range(17, 22)
+(IF_EQ_GOTO, IF_GT_GOTO, IF_LT_GOTO) = range(22, 25)
+(IF_NE_GOTO, IF_LE_GOTO, IF_GE_GOTO) = range(25, 28)
+
+SEGMENTS = [
+    "argument",
+    "local",
+    "static",
+    "constant",
+    "this",
+    "that",
+    "pointer",
+    "temp",
+]
+SEGMENT_IDS = {name: i for i, name in enumerate(SEGMENTS)}
+(ARGUMENT, LOCAL, STATIC, CONSTANT, THIS, THAT, POINTER, TEMP) = range(8)
+
+# commands whose symbol is a label or function name
+NAMED = frozenset(
+    (LABEL, GOTO, IF_GOTO, FUNCTION, CALL, IF_NOT_GOTO)
+    + tuple(range(IF_EQ_GOTO, IF_GE_GOTO + 1))
+)
+
+
+def pack_segments(segment: int, from_segment: int) -> int:
+    """
+    pop-to has two segments; they share the segment field, four bits each.
+    """
+    return segment | from_segment << 4
+
+
+def unpack_segments(packed: int) -> t.Tuple[int, int]:
+    return packed & 0xF, packed >> 4
+
+
+class Program:
+    """
+    Commands as parallel arrays of opcodes, segments, operands and symbols.
+
+    The operand is the index, count or constant of a command. The symbol is
+    the id of a label or function name, or a second operand for the fused
+    commands: k for inc, and the source index for pop-to. Programs made with
+    like() share their names, so ids stay valid across rewrites.
+    """
+
+    def __init__(self):
+        self.ops = array("B")
+        self.segments = array("B")
+        self.operands = array("i")
+        self.symbols = array("i")
+        self.names = []
+        self.name_ids = dict()
+
+    def like(self):
+        """
+        An empty program sharing this one's interned names.
+        """
+        res = Program()
+        res.names = self.names
+        res.name_ids = self.name_ids
+        return res
+
+    def intern(self, name: str) -> int:
+        try:
+            return self.name_ids[name]
+        except KeyError:
+            self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            return self.name_ids[name]
+
+    def append(self, op: int, segment=0, operand=0, symbol=0):
+        self.ops.append(op)
+        self.segments.append(segment)
+        self.operands.append(operand)
+        self.symbols.append(symbol)
+
+    def extend(self, commands):
+        for cmd in commands:
+            self.append(*cmd)
+
+    def append_words(self, words: t.Sequence[str]):
+        """
+        Encodes a command given as its whitespace-separated words.
+        """
+        op = OPCODE_IDS[words[0]]
+        if op in (PUSH, POP, STORE):
+            self.append(op, SEGMENT_IDS[words[1]], int(words[2]))
+        elif op in (FUNCTION, CALL):
+            self.append(op, operand=int(words[2]), symbol=self.intern(words[1]))
+        elif op in NAMED:
+            self.append(op, symbol=self.intern(words[1]))
+        elif op == INC:
+            segment, index, k = words[1:]
+            self.append(op, SEGMENT_IDS[segment], int(index), int(k))
+        elif op == PUSH_ADD:
+            self.append(op, SEGMENT_IDS[words[1]], int(words[2]))
+        elif op == POP_TO:
+            segment, index, from_segment, from_index = words[1:]
+            packed = pack_segments(SEGMENT_IDS[segment], SEGMENT_IDS[from_segment])
+            self.append(op, packed, int(index), int(from_index))
+        else:
+            self.append(op)
+
+    def words(self, cmd) -> t.List[str]:
+        """
+        The words of cmd as they would be written in a .vm file.
+        """
+        op, segment, operand, symbol = cmd
+        if op in (PUSH, POP, STORE, PUSH_ADD):
+            return [OPCODES[op], SEGMENTS[segment], str(operand)]
+        if op in (FUNCTION, CALL):
+            return [OPCODES[op], self.names[symbol], str(operand)]
+        if op in NAMED:
+            return [OPCODES[op], self.names[symbol]]
+        if op == INC:
+            return [OPCODES[op], SEGMENTS[segment], str(operand), str(symbol)]
+        if op == POP_TO:
+            segment, from_segment = unpack_segments(segment)
+            words = [SEGMENTS[segment], str(operand), SEGMENTS[from_segment]]
+            return [OPCODES[op], *words, str(symbol)]
+        return [OPCODES[op]]
+
+    def name(self, cmd) -> str:
+        return self.names[cmd[3]]
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __getitem__(self, i: int):
+        return self.ops[i], self.segments[i], self.operands[i], self.symbols[i]
+
+    def __iter__(self):
+        return zip(self.ops, self.segments, self.operands, self.symbols)
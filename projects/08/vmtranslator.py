@@ -1,9 +1,19 @@
 import argparse
+import csv
+import functools
+import hashlib
+import json
+import mmap
 import os
 import re
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from enum import Enum
 
 import helpers as h
+import vmir as ir
 
 
 class C(str, Enum):
@@ -18,50 +28,98 @@ class C(str, Enum):
     CALL = "CALL"
 
 
+COMMAND_TYPES = {
+    **{name: C.ARITHMETIC for name in ir.OPCODES[ir.ADD : ir.NOT + 1]},
+    "push": C.PUSH,
+    "pop": C.POP,
+    "label": C.LABEL,
+    "goto": C.GOTO,
+    "if-goto": C.IF,
+    "function": C.FUNCTION,
+    "return": C.RETURN,
+    "call": C.CALL,
+}
+
+
 class Parser:
     def __init__(self, filepath):
-        with open(filepath, "r") as f:
-            self.lines = f.readlines()
-        self._clean_lines()
+        with open(filepath, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buf = b""
+        self.offsets = self._index_lines()
+        self.cursor, self.current = self._seek(0)
+        self.lookahead = None
+
+    def _index_lines(self):
+        """
+        Byte offset at which each line starts, followed by the end of the file.
+        """
+        offsets = array("Q", [0])
+        offsets.extend(m.end() for m in re.finditer(rb"\n", self.buf))
+        offsets.append(len(self.buf))
+        return offsets
+
+    def _clean_line(self, i: int) -> str:
+        line = self.buf[self.offsets[i] : self.offsets[i + 1]].decode()
+        return line.partition("//")[0].strip()
 
-    def _clean_lines(self):
-        self.lines = [re.sub(r"\s*//.*$", "", line.strip()) for line in self.lines]
-        self.lines = [line for line in self.lines if line]
+    def _seek(self, i: int):
+        """
+        Returns (index, text) of the first line at or after i holding a
+        command, or (None, None) if there is none.
+        """
+        while i < len(self.offsets) - 1:
+            line = self._clean_line(i)
+            if line:
+                return i, line
+            i += 1
+        return None, None
 
     @property
     def cmd(self):
-        return self.lines[0]
+        return self.current
 
     @property
     def hasMoreCommands(self) -> bool:
-        return len(self.lines) > 1
+        if self.cursor is None:
+            return False
+        if self.lookahead is None:
+            self.lookahead = self._seek(self.cursor + 1)
+        return self.lookahead[0] is not None
 
     def advance(self):
         if self.hasMoreCommands:
-            self.lines.pop(0)
+            self.cursor, self.current = self.lookahead
+            self.lookahead = None
+
+    def commands(self):
+        """
+        Yields the remaining commands, advancing the parser through them.
+        """
+        if self.cursor is None:
+            return
+        while True:
+            yield self.cmd
+            if not self.hasMoreCommands:
+                break
+            self.advance()
+
+    def program(self):
+        """
+        Encodes the remaining commands, advancing the parser through them.
+        """
+        res = ir.Program()
+        for cmd in self.commands():
+            res.append_words(cmd.split())
+        return res
 
     @property
     def commandType(self) -> str:
-        first_word = self.cmd.split()[0]
-        if first_word in ("add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"):
-            return C.ARITHMETIC
-        elif first_word == "push":
-            return C.PUSH
-        elif first_word == "pop":
-            return C.POP
-        elif first_word == "label":
-            return C.LABEL
-        elif first_word == "goto":
-            return C.GOTO
-        elif first_word == "if-goto":
-            return C.IF
-        elif first_word == "function":
-            return C.FUNCTION
-        elif first_word == "return":
-            return C.RETURN
-        elif first_word == "call":
-            return C.CALL
-        else:
+        try:
+            return COMMAND_TYPES[self.cmd.split(maxsplit=1)[0]]
+        except KeyError:
             raise ValueError
 
     @property
@@ -81,12 +139,148 @@ class Parser:
             return NotImplementedError
 
 
+def _wrap(value: int) -> int:
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+
+def _same_location(window):
+    # push s i / pop s i -> nothing
+    first, second = window
+    if first[0] == ir.PUSH and second[0] == ir.POP and first[1:3] == second[1:3]:
+        return []
+
+
+def _increment(window):
+    # push s i / push-add constant k / pop s i -> inc s i k
+    first, second, third = window
+    if first[0] == ir.PUSH and second[0] == ir.PUSH_ADD and third[0] == ir.POP:
+        if first[1:3] == third[1:3]:
+            return [(ir.INC, first[1], first[2], second[2])]
+
+
+def _fold_constant(window):
+    # push constant k / not -> push constant ~k, and likewise for neg
+    first, second = window
+    if first[:2] == (ir.PUSH, ir.CONSTANT) and second[0] in (ir.NOT, ir.NEG):
+        k = first[2]
+        value = ~k if second[0] == ir.NOT else _wrap(-k)
+        return [(ir.PUSH, ir.CONSTANT, value, 0)]
+
+
+def _add_constant(window):
+    # push constant k / add -> push-add constant k, and sub as adding -k
+    first, second = window
+    if first[:2] == (ir.PUSH, ir.CONSTANT) and second[0] in (ir.ADD, ir.SUB):
+        k = first[2] if second[0] == ir.ADD else -first[2]
+        # fused commands load abs(k) into A, which has to fit an A-command
+        if abs(k) <= 0x7FFF:
+            return [(ir.PUSH_ADD, ir.CONSTANT, k, 0)]
+
+
+def _move(window):
+    # push s i / pop t j -> pop-to t j s i
+    first, second = window
+    if first[0] == ir.PUSH and second[0] == ir.POP:
+        segments = ir.pack_segments(second[1], first[1])
+        return [(ir.POP_TO, segments, second[2], first[2])]
+
+
+def _negated_branch(window):
+    # not / if-goto l -> if-not-goto l
+    if window[0][0] == ir.NOT and window[1][0] == ir.IF_GOTO:
+        return [(ir.IF_NOT_GOTO, 0, 0, window[1][3])]
+
+
+def _compare_branch(window):
+    # eq / if-goto l -> if-eq-goto l, and likewise for gt and lt; after
+    # _negated_branch the jump condition is inverted instead
+    direct = {ir.EQ: ir.IF_EQ_GOTO, ir.GT: ir.IF_GT_GOTO, ir.LT: ir.IF_LT_GOTO}
+    inverse = {ir.EQ: ir.IF_NE_GOTO, ir.GT: ir.IF_LE_GOTO, ir.LT: ir.IF_GE_GOTO}
+    first, second = window
+    if first[0] in direct and second[0] in (ir.IF_GOTO, ir.IF_NOT_GOTO):
+        table = direct if second[0] == ir.IF_GOTO else inverse
+        return [(table[first[0]], 0, 0, second[3])]
+
+
+def _direct_pop(window):
+    # pop to an address known at translation time, e.g. pop temp 0 after a
+    # call to a void function
+    (cmd,) = window
+    if cmd[0] == ir.POP and cmd[1] in (ir.TEMP, ir.POINTER, ir.STATIC):
+        return [(ir.STORE, *cmd[1:])]
+
+
+VM_PEEPHOLE_RULES = [
+    (2, _same_location),
+    (3, _increment),
+    (2, _fold_constant),
+    (2, _add_constant),
+    (2, _move),
+    (2, _negated_branch),
+    (2, _compare_branch),
+    (1, _direct_pop),
+]
+
+
+def vm_peephole(program):
+    """
+    Rewrites a program with VM_PEEPHOLE_RULES, replacing common sequences with
+    cheaper fused commands that CodeWriter understands.
+
+    As with the assembler's peephole pass, rewriting happens at the end of the
+    output as each command is appended, and no rule matches across a label or
+    function declaration since control can arrive there from elsewhere.
+    Returns the rewritten program and how often each rule fired.
+    """
+    res = []
+    counts = Counter()
+    for cmd in program:
+        res.append(cmd)
+        changed = True
+        while changed:
+            changed = False
+            for width, rule in VM_PEEPHOLE_RULES:
+                window = res[-width:]
+                if len(window) < width or any(
+                    w[0] in (ir.LABEL, ir.FUNCTION) for w in window
+                ):
+                    continue
+                replacement = rule(window)
+                if replacement is not None:
+                    res[-width:] = replacement
+                    counts[rule.__name__.lstrip("_")] += 1
+                    changed = True
+                    break
+    optimized = program.like()
+    optimized.extend(res)
+    return optimized, counts
+
+
+IF_COMPARE_GOTO = {
+    ir.IF_EQ_GOTO: "eq",
+    ir.IF_GT_GOTO: "gt",
+    ir.IF_LT_GOTO: "lt",
+    ir.IF_NE_GOTO: "ne",
+    ir.IF_LE_GOTO: "le",
+    ir.IF_GE_GOTO: "ge",
+}
+
+
 class CodeWriter:
-    def __init__(self):
+    def __init__(self, trampolines=False, cache_tos=False, zero_fill=False):
         self.output = []
         self.compare_counter = 0
         self.function_call_counter = 0
         self.function_name = None
+        self.label_scope = None
+        self.trampolines = trampolines
+        self.cache_tos = cache_tos
+        self.zero_fill = zero_fill
+        # whether the top of the stack is held in D rather than in RAM
+        self.tos_in_d = False
+        # whether D holds a value exactly as a push loaded it
+        self.tos_pushed = False
+        self.stats = dict()
 
     def setFileName(self, file_name: str):
         self.file_name = file_name
@@ -97,11 +291,56 @@ class CodeWriter:
     def unsetFunctionName(self):
         self.function_name = None
 
+    def setLabelScope(self, scope: str):
+        """
+        Makes the labels generated for comparisons and return addresses unique
+        to scope, so that they no longer depend on what was translated before.
+        """
+        self.label_scope = scope
+
+    def _label_id(self, counter: int):
+        if self.label_scope is None:
+            return counter
+        return f"_{self.label_scope}.{counter}"
+
+    def _spill(self):
+        """
+        Stores a top of stack held in D, so that the stack is all in RAM.
+        """
+        if self.tos_in_d:
+            self._count("spills")
+            if self.tos_pushed:
+                self._count("pushes_spilled")
+            self.output += h.spill_d()
+            self.tos_in_d = False
+
+    def _fill(self):
+        """
+        Brings the top of the stack into D.
+        """
+        if not self.tos_in_d:
+            self.output += h.fill_d()
+            self.tos_in_d = True
+            self.tos_pushed = False
+
     def writeArithmetic(self, command: str):
-        if command in ("add", "sub", "and", "or"):
+        if self.cache_tos:
+            self._fill()
+            self.tos_pushed = False
+            if command in ("add", "sub", "and", "or"):
+                self.output += h.binop_d(command)
+            elif command in ("eq", "gt", "lt"):
+                s = self._label_id(self.compare_counter)
+                self.output += h.compare_d(command, s=s)
+                self.compare_counter += 1
+            elif command in ("neg", "not"):
+                self.output += h.unop_d(command)
+            else:
+                raise NotImplementedError
+        elif command in ("add", "sub", "and", "or"):
             self.output += h.binop(command)
         elif command in ("eq, gt, lt"):
-            self.output += h.compare(command, s=self.compare_counter)
+            self.output += h.compare(command, s=self._label_id(self.compare_counter))
             self.compare_counter += 1
         elif command in ("neg", "not"):
             self.output += h.unop(command)
@@ -121,68 +360,262 @@ class CodeWriter:
             "temp",
         )
 
-        try:
-            if segment == "static":
-                f = eval(f"h.{command}_static")
-                self.output += f(index, self.file_name)
-            else:
-                f = eval(f"h.{command}_{segment}")
-                self.output += f(index)
-        except Exception as e:
-            raise e
+        file_name = self.file_name if segment == "static" else None
+        if not self.cache_tos:
+            self.output += h.push_pop(command, segment, index, file_name)
+        elif command == "push":
+            self._spill()
+            self._count("pushes")
+            self.output += h.load_to_d(segment, index, file_name)
+            self.tos_in_d = True
+            self.tos_pushed = True
+        else:
+            self._fill()
+            self.output += h.store_d(segment, index, file_name)
+            self.tos_in_d = False
+
+    def writeIncrement(self, segment: str, index: int, k: int):
+        self._spill()
+        file_name = self.file_name if segment == "static" else None
+        self.output += h.increment(segment, index, k, file_name)
+
+    def writePushAdd(self, k: int):
+        if self.cache_tos:
+            self._fill()
+            self.tos_pushed = False
+            self.output += h.push_add_constant_d(k)
+        else:
+            self.output += h.push_add_constant(k)
+
+    def writeMove(self, segment: str, index: int, from_segment: str, from_index: int):
+        self._spill()
+        self.output += h.move(segment, index, from_segment, from_index, self.file_name)
+
+    def writeStore(self, segment: str, index: int):
+        file_name = self.file_name if segment == "static" else None
+        if self.cache_tos:
+            self._fill()
+            self.output += h.store_d(segment, index, file_name)
+            self.tos_in_d = False
+        else:
+            self.output += h.store(segment, index, file_name)
+
+    def writeIfNot(self, label: str):
+        if self.cache_tos:
+            self._fill()
+            self.output += h.if_not_goto_label_d(label, self.function_name)
+            self.tos_in_d = False
+        else:
+            self.output += h.if_not_goto_label(label, self.function_name)
+
+    def writeIfCompare(self, compare: str, label: str):
+        if self.cache_tos:
+            self._fill()
+            self.output += h.if_compare_goto_label_d(
+                compare, label, self.function_name
+            )
+            self.tos_in_d = False
+        else:
+            self.output += h.if_compare_goto_label(compare, label, self.function_name)
 
     def writeInit(self):
         self.output += h.initialize()
 
     def writeLabel(self, label: str):
+        # a jump may arrive here, and jumps leave the whole stack in RAM
+        self._spill()
         self.output += h.assign_label(label, self.function_name)
 
     def writeGoto(self, label: str):
+        self._spill()
         self.output += h.goto_label(label, self.function_name)
 
     def writeIf(self, label: str):
-        self.output += h.if_goto_label(label, self.function_name)
+        if self.cache_tos:
+            self._fill()
+            self.output += h.if_goto_label_d(label, self.function_name)
+            self.tos_in_d = False
+        else:
+            self.output += h.if_goto_label(label, self.function_name)
+
+    def _count(self, stat: str, n=1):
+        self.stats[stat] = self.stats.get(stat, 0) + n
 
     def writeCall(self, function_name: str, num_args: int):
-        self.output += h.call_function(
-            function_name, num_args, self.function_call_counter
-        )
+        self._spill()
+        if self.trampolines:
+            res = h.call_via_trampoline(
+                function_name, num_args, self._label_id(self.function_call_counter)
+            )
+            inline = h.call_function(
+                function_name, num_args, self._label_id(self.function_call_counter)
+            )
+            self._count("calls")
+            self._count(
+                "call_words_saved",
+                h.count_instructions(inline) - h.count_instructions(res),
+            )
+            self.output += res
+        else:
+            self.output += h.call_function(
+                function_name, num_args, self._label_id(self.function_call_counter)
+            )
         self.function_call_counter += 1
 
     def writeReturn(self):
-        self.output += h.return_from_function()
+        self._spill()
+        if self.trampolines:
+            self._count("returns")
+            self.output += h.return_via_trampoline()
+        else:
+            self.output += h.return_from_function()
         # self.unsetFunctionName()
 
     def writeFunction(self, function_name: str, num_locals: int):
+        self._spill()
         self.setFunctionName(function_name)
-        self.output += h.declare_function(function_name, num_locals)
+        if not self.zero_fill:
+            self.output += h.declare_function(function_name, num_locals)
+            return
+
+        res = h.declare_function_compact(function_name, num_locals)
+        inline = h.declare_function(function_name, num_locals)
+        self._count(
+            "zero_fill_words_saved",
+            h.count_instructions(inline) - h.count_instructions(res),
+        )
+        if num_locals and h.zero_fill_strategy(num_locals) == "routine":
+            self._count("zero_fill_sites")
+        self.output += res
 
     def writeLine(self, *args):
-        self.output += [f"// {' '.join(args)}"]
-        if args[0] in ("add", "sub", "and", "or", "eq", "gt", "lt", "neg", "not"):
-            self.writeArithmetic(*args)
-        elif args[0] == "label":
-            self.writeLabel(*args[1:])
-        elif args[0] == "goto":
-            self.writeGoto(*args[1:])
-        elif args[0] == "if-goto":
-            self.writeIf(*args[1:])
-        elif args[0] == "call":
-            function_name, num_args = args[1:]
-            self.writeCall(function_name, int(num_args))
-        elif args[0] == "return":
+        program = ir.Program()
+        program.append_words(args)
+        self.writeCommand(program[0], program)
+
+    def writeCommand(self, cmd, program):
+        """
+        Writes one encoded command; program holds the names it refers to.
+        """
+        self.output += [f"// {' '.join(program.words(cmd))}"]
+        op, segment, operand, symbol = cmd
+        if op <= ir.NOT:
+            self.writeArithmetic(ir.OPCODES[op])
+        elif op in (ir.PUSH, ir.POP):
+            self.writePushPop(ir.OPCODES[op], ir.SEGMENTS[segment], operand)
+        elif op == ir.LABEL:
+            self.writeLabel(program.name(cmd))
+        elif op == ir.GOTO:
+            self.writeGoto(program.name(cmd))
+        elif op == ir.IF_GOTO:
+            self.writeIf(program.name(cmd))
+        elif op == ir.CALL:
+            self.writeCall(program.name(cmd), operand)
+        elif op == ir.RETURN:
             self.writeReturn()
-        elif args[0] == "function":
-            function_name, num_locals = args[1:]
-            self.writeFunction(function_name, int(num_locals))
-        elif args[0] in ("push", "pop"):
-            command, segment, index = args
-            self.writePushPop(command, segment, int(index))
+        elif op == ir.FUNCTION:
+            self.writeFunction(program.name(cmd), operand)
+        # fused commands from vm_peephole
+        elif op == ir.INC:
+            self.writeIncrement(ir.SEGMENTS[segment], operand, symbol)
+        elif op == ir.PUSH_ADD:
+            self.writePushAdd(operand)
+        elif op == ir.POP_TO:
+            segment, from_segment = ir.unpack_segments(segment)
+            self.writeMove(
+                ir.SEGMENTS[segment], operand, ir.SEGMENTS[from_segment], symbol
+            )
+        elif op == ir.STORE:
+            self.writeStore(ir.SEGMENTS[segment], operand)
+        elif op == ir.IF_NOT_GOTO:
+            self.writeIfNot(program.name(cmd))
+        elif op in IF_COMPARE_GOTO:
+            self.writeIfCompare(IF_COMPARE_GOTO[op], program.name(cmd))
         else:
             raise ValueError("Command in line not recognized")
 
+    def writeProgram(self, program):
+        for cmd in program:
+            self.writeCommand(cmd, program)
+
     def _finish(self):
+        self._spill()
         self.output += h.finish()
+        if self.stats.get("calls"):
+            self.output += h.call_routine()
+        if self.stats.get("returns"):
+            self.output += h.return_routine()
+        if self.stats.get("zero_fill_sites"):
+            self.output += h.zero_fill_routine()
+
+    def report(self):
+        """
+        Lines summarising what the enabled optimizations did.
+        """
+        res = []
+        if "fragments" in self.stats:
+            reused = self.stats.get("fragments_reused", 0)
+            res.append(
+                f"Reused {reused} of {self.stats['fragments']} cached fragments."
+            )
+        if self.trampolines:
+            calls = self.stats.get("calls", 0)
+            returns = self.stats.get("returns", 0)
+            call_routine = h.count_instructions(h.call_routine())
+            return_routine = h.count_instructions(h.return_routine())
+            inline_return = h.count_instructions(h.return_from_function())
+            return_site = h.count_instructions(h.return_via_trampoline())
+            saved = (
+                self.stats.get("call_words_saved", 0)
+                + returns * (inline_return - return_site)
+                - (call_routine if calls else 0)
+                - (return_routine if returns else 0)
+            )
+            # call sites and routines are straight-line code, so the extra
+            # cycles are the extra instructions executed
+            inline_call = h.count_instructions(h.call_function("f", 2, 0))
+            call_site = h.count_instructions(h.call_via_trampoline("f", 2, 0))
+            extra_call = call_site + call_routine - inline_call
+            extra_return = return_site + return_routine - inline_return
+            res.append(
+                f"Trampolines saved {saved} ROM words over {calls} calls and "
+                f"{returns} returns, at +{extra_call} cycles per call "
+                f"({extra_call - 2} with 0 or 1 arguments) and +{extra_return} "
+                f"per return."
+            )
+        if self.zero_fill:
+            sites = self.stats.get("zero_fill_sites", 0)
+            routine = h.count_instructions(h.zero_fill_routine()) if sites else 0
+            saved = self.stats.get("zero_fill_words_saved", 0) - routine
+            res.append(
+                f"Compact zero-fill of locals saved {saved} ROM words; {sites} "
+                f"functions use the shared routine."
+            )
+        if self.cache_tos:
+            pushes = self.stats.get("pushes", 0)
+            kept = pushes - self.stats.get("pushes_spilled", 0)
+            spills = self.stats.get("spills", 0)
+            res.append(
+                f"Top-of-stack caching kept {kept} of {pushes} pushed values in "
+                f"D; D had to be stored {spills} times."
+            )
+        return res
+
+    def drain(self):
+        """
+        Yields everything written so far and forgets it.
+        """
+        output, self.output = self.output, []
+        yield from output
+
+    def stream(self, program):
+        """
+        Translates a program one command at a time, yielding each one's
+        assembly as soon as it is written rather than keeping it in output.
+        """
+        for cmd in program:
+            self.writeCommand(cmd, program)
+            yield from self.drain()
 
     def to_disk(self, file_path: str):
         self._finish()
@@ -191,48 +624,478 @@ class CodeWriter:
             f.write("\n")
 
 
-def translate_single_file(file_path, skip_bootstrap=False):
-    file_name = re.findall(r"\w+", file_path)[-2]
+def call_graph(file_paths):
+    """
+    Maps each function declared in file_paths to the names it calls. Calls
+    made outside any function are listed under None.
+    """
+    graph = {None: set()}
+    for file_path in file_paths:
+        calls = graph[None]
+        program = Parser(file_path).program()
+        for cmd in program:
+            if cmd[0] == ir.FUNCTION:
+                calls = graph.setdefault(program.name(cmd), set())
+            elif cmd[0] == ir.CALL:
+                calls.add(program.name(cmd))
+    return graph
+
 
-    p = Parser(file_path)
-    cw = CodeWriter()
+def unreachable_functions(graph, root="Sys.init"):
+    """
+    Functions in graph that no chain of calls from root (or from code outside
+    any function) reaches. Nothing is unreachable when root is not declared,
+    as then the program's entry point is not known.
+    """
+    if root not in graph:
+        return []
+    seen = set()
+    pending = [None, root]
+    while pending:
+        function_name = pending.pop()
+        if function_name in seen or function_name not in graph:
+            continue
+        seen.add(function_name)
+        pending.extend(graph[function_name])
+    return sorted(f for f in graph if f not in seen)
+
+
+def drop_functions(program, dead):
+    """
+    Leaves out the declarations and bodies of the functions named in dead.
+    """
+    res = program.like()
+    keep = True
+    for cmd in program:
+        if cmd[0] == ir.FUNCTION:
+            keep = program.name(cmd) not in dead
+        if keep:
+            res.append(*cmd)
+    return res
+
+
+def read_commands(file_path, optimize=False, rewrites=None, dead=()):
+    """
+    The program in a .vm file without the functions named in dead, rewritten
+    by vm_peephole if optimize is set, in which case the number of times each
+    rule fired is added to rewrites.
+    """
+    program = Parser(file_path).program()
+    if dead:
+        program = drop_functions(program, dead)
+    if optimize:
+        program, counts = vm_peephole(program)
+        rewrites.update(counts)
+    return program
+
+
+def report_rewrites(rewrites):
+    if rewrites:
+        counts = ", ".join(f"{rule} {n}" for rule, n in rewrites.most_common())
+        print(f"VM peephole made {sum(rewrites.values())} rewrites ({counts}).")
+
+
+BOOTSTRAP = "(bootstrap)"
+RUNTIME = "(runtime)"
+
+
+def path_length(lines, routines=None) -> int:
+    """
+    Instructions executed by one pass through lines. Conditional jumps are
+    assumed not taken and forward jumps to labels within lines are followed;
+    a jump to one of the shared routines in routines (name -> path length)
+    adds that routine's path. Jumps anywhere else are assumed to come back,
+    as calls do, and execution carries on with the next line.
+    """
+    routines = routines or dict()
+    labels = {line[1:-1]: i for i, line in enumerate(lines) if line[0] == "("}
+    count, address, i = 0, None, 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if line[0] == "(" or line.startswith("//"):
+            continue
+        count += 1
+        if line[0] == "@":
+            address = line[1:]
+            continue
+        if line.endswith(";JMP"):
+            if labels.get(address, -1) >= i:
+                i = labels[address]
+            elif address in routines:
+                count += routines[address]
+        if "A" in line.partition("=")[0] and "=" in line:
+            address = None
+    return count
+
+
+def function_costs(lines):
+    """
+    ROM words and estimated cycles of each VM function in translated assembly,
+    broken down by the kind of VM command that produced them, using the
+    comment CodeWriter writes before each command.
+
+    The cycle estimate is that of running every command of the function once,
+    measured with path_length, so it covers straight-line paths but neither
+    loops nor the callees of calls. Code before the first function is listed
+    under BOOTSTRAP, and the end loop and shared routines under RUNTIME; the
+    routines' cycles are charged to the call and return sites using them.
+    """
+    lines = [line for line in lines if line]
+    end = lines.index("(END)") if "(END)" in lines else len(lines)
+    runtime = lines[end:]
+    # every shared routine ends in an unconditional jump, and any label in
+    # one may be jumped to
+    routines = dict()
+    start = 0
+    for i, line in enumerate(runtime):
+        if line == "0;JMP":
+            section = runtime[start : i + 1]
+            for j, label in enumerate(section):
+                if label[0] == "(":
+                    routines[label[1:-1]] = path_length(section[j:])
+            start = i + 1
+
+    costs = dict()
+
+    def add(function_name, kind, chunk, routines=None):
+        entry = costs.setdefault(function_name, dict()).setdefault(
+            kind, dict(commands=0, words=0, cycles=0)
+        )
+        entry["commands"] += 1
+        entry["words"] += h.count_instructions(chunk)
+        if routines is not None:
+            entry["cycles"] += path_length(chunk, routines)
+
+    # the bootstrap's own comments name a call, but it is all one chunk
+    bootstrap = h.initialize()
+    start = len(bootstrap) if lines[: len(bootstrap)] == bootstrap else 0
+    if start:
+        add(BOOTSTRAP, "bootstrap", bootstrap, routines)
+
+    function_name, kind, chunk = BOOTSTRAP, None, []
+    for line in lines[start:end]:
+        words = line[3:].split() if line.startswith("// ") else None
+        if words and words[0] in ir.OPCODE_IDS:
+            if kind is not None or chunk:
+                add(function_name, kind or "bootstrap", chunk, routines)
+            kind, chunk = words[0], []
+            if kind == "function":
+                function_name = words[1]
+        else:
+            chunk.append(line)
+    if kind is not None or chunk:
+        add(function_name, kind or "bootstrap", chunk, routines)
+    if runtime:
+        add(RUNTIME, "runtime", runtime)
+    return costs
+
+
+def cost_rows(costs):
+    """
+    One summary per function, the largest in ROM first.
+    """
+    rows = []
+    for function_name, kinds in costs.items():
+        row = {"function": function_name, "class": function_name.split(".")[0]}
+        for field in ("commands", "words", "cycles"):
+            row[field] = sum(entry[field] for entry in kinds.values())
+        row["kinds"] = kinds
+        rows.append(row)
+    return sorted(rows, key=lambda row: (-row["words"], row["function"]))
+
+
+def write_costs(costs, path: str):
+    """
+    Writes function_costs as JSON, or as CSV with one row per function and
+    command kind plus a "total" row per function if path ends in .csv.
+    """
+    rows = cost_rows(costs)
+    with open(path, "w", newline="") as f:
+        if not path.endswith(".csv"):
+            json.dump(rows, f, indent=2)
+            return
+        fields = ["function", "class", "kind", "commands", "words", "cycles"]
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        for row in rows:
+            for kind, entry in sorted(row["kinds"].items()):
+                writer.writerow([row["function"], row["class"], kind, *entry.values()])
+            totals = [row["commands"], row["words"], row["cycles"]]
+            writer.writerow([row["function"], row["class"], "total", *totals])
+
+
+def report_costs(asm_path: str, costs_path: str):
+    with open(asm_path, "r") as f:
+        write_costs(function_costs(f.read().splitlines()), costs_path)
+
+
+def stream_files(
+    cw, file_paths, skip_bootstrap=False, optimize=False, rewrites=None, dead=()
+):
+    """
+    Yields the assembly for a whole program, parsing each file only when its
+    turn comes, so memory use does not grow with the number of files.
+    """
+    if not skip_bootstrap:
+        cw.writeInit()
+        yield from cw.drain()
+    for file_path in file_paths:
+        cw.setFileName(file_name=re.findall(r"\w+", file_path)[-2])
+        yield from cw.stream(read_commands(file_path, optimize, rewrites, dead))
+    cw._finish()
+    yield from cw.drain()
+
+
+def translate_file(file_path, options, optimize=False, dead=()):
+    """
+    Translates one file on its own, with its labels scoped to the file, as a
+    fragment for translate_parallel. Returns the fragment's lines and the
+    CodeWriter's and peephole's statistics.
+    """
+    cw = CodeWriter(**options)
+    file_name = re.findall(r"\w+", file_path)[-2]
     cw.setFileName(file_name=file_name)
+    cw.setLabelScope(file_name)
+    rewrites = Counter()
+    cw.writeProgram(read_commands(file_path, optimize, rewrites, dead))
+    # the next fragment must find the whole stack in RAM
+    cw._spill()
+    return cw.output, cw.stats, rewrites
+
+
+@functools.lru_cache(maxsize=None)
+def translator_digest() -> bytes:
+    """
+    Hash of the translator's own source, so that cached fragments are not
+    reused after it changes.
+    """
+    digest = hashlib.sha256()
+    for module_path in (__file__, h.__file__, ir.__file__):
+        with open(module_path, "rb") as f:
+            digest.update(f.read())
+    return digest.digest()
 
+
+def fragment_key(file_path, options, optimize=False, dead=()) -> str:
+    """
+    Cache key of the fragment translate_file would produce for file_path.
+    """
+    digest = hashlib.sha256(translator_digest())
+    settings = [os.path.basename(file_path), options, optimize, sorted(dead)]
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    with open(file_path, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def load_fragment(cache_dir, key):
+    try:
+        with open(os.path.join(cache_dir, f"{key}.json"), "r") as f:
+            fragment = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return fragment["lines"], fragment["stats"], Counter(fragment["rewrites"])
+
+
+def save_fragment(cache_dir, key, fragment):
+    lines, stats, rewrites = fragment
+    path = os.path.join(cache_dir, f"{key}.json")
+    # written under another name first so that an interrupted run cannot
+    # leave a truncated fragment behind
+    with open(path + ".tmp", "w") as f:
+        json.dump(dict(lines=lines, stats=stats, rewrites=rewrites), f)
+    os.replace(path + ".tmp", path)
+
+
+def translate_parallel(
+    cw,
+    file_paths,
+    jobs,
+    options,
+    skip_bootstrap=False,
+    optimize=False,
+    rewrites=None,
+    dead=(),
+    cache_dir=None,
+):
+    """
+    Yields the assembly for a whole program, translating the files in jobs
+    worker processes with the given CodeWriter options. Fragments follow the
+    bootstrap in sorted path order, and since their labels are file-scoped
+    the output does not depend on jobs.
+
+    With cache_dir, fragments are kept there keyed by fragment_key, and only
+    files without a cached fragment are translated. Fragments no longer used
+    are removed.
+    """
     if not skip_bootstrap:
         cw.writeInit()
-    while True:
-        cmd = p.cmd.split()
-        cw.writeLine(*cmd)
-        if p.hasMoreCommands:
-            p.advance()
+        yield from cw.drain()
+
+    file_paths = sorted(file_paths)
+    keys = dict()
+    cached = dict()
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        for file_path in file_paths:
+            keys[file_path] = fragment_key(file_path, options, optimize, dead)
+            fragment = load_fragment(cache_dir, keys[file_path])
+            if fragment is not None:
+                cached[file_path] = fragment
+    missing = [file_path for file_path in file_paths if file_path not in cached]
+
+    args = (missing, repeat(options), repeat(optimize), repeat(dead))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        if jobs > 1:
+            translated = executor.map(translate_file, *args)
         else:
-            break
-    cw.to_disk(file_path=file_path.replace(".vm", ".asm"))
+            translated = map(translate_file, *args)
+        for file_path in file_paths:
+            if file_path in cached:
+                fragment = cached[file_path]
+                cw._count("fragments_reused")
+            else:
+                fragment = next(translated)
+                if cache_dir is not None:
+                    save_fragment(cache_dir, keys[file_path], fragment)
+            lines, stats, counts = fragment
+            for stat, n in stats.items():
+                cw._count(stat, n)
+            rewrites.update(counts)
+            yield from lines
+
+    if cache_dir is not None:
+        used = {f"{key}.json" for key in keys.values()}
+        for file in os.listdir(cache_dir):
+            if file.endswith(".json") and file not in used:
+                os.remove(os.path.join(cache_dir, file))
+        cw._count("fragments", len(file_paths))
+
+    cw._finish()
+    yield from cw.drain()
+
+
+def stream_to_disk(lines, file_path: str):
+    """
+    Writes lines as they are produced; the file's buffer flushes them to disk
+    incrementally. Matches the format of CodeWriter.to_disk.
+    """
+    with open(file_path, "w") as f:
+        f.writelines(f"{line}\n" for line in lines)
+        f.write("\n")
+
+
+def translate_single_file(
+    file_path,
+    skip_bootstrap=False,
+    stream=False,
+    optimize=False,
+    costs=None,
+    **options,
+):
+    """
+    optimize runs vm_peephole over the commands, and costs is a path to write
+    the per-function cost report to; options are passed on to the CodeWriter.
+    """
+    cw = CodeWriter(**options)
+    rewrites = Counter()
+    if stream:
+        lines = stream_files(
+            cw, [file_path], skip_bootstrap, optimize=optimize, rewrites=rewrites
+        )
+        stream_to_disk(lines, file_path=file_path.replace(".vm", ".asm"))
+    else:
+        file_name = re.findall(r"\w+", file_path)[-2]
+        cw.setFileName(file_name=file_name)
+
+        if not skip_bootstrap:
+            cw.writeInit()
+        cw.writeProgram(read_commands(file_path, optimize, rewrites))
+        cw.to_disk(file_path=file_path.replace(".vm", ".asm"))
+
+    if costs is not None:
+        report_costs(file_path.replace(".vm", ".asm"), costs)
+    report_rewrites(rewrites)
+    for line in cw.report():
+        print(line)
 
 
-def translate_directory(path, skip_bootstrap=False):
+def translate_directory(
+    path,
+    skip_bootstrap=False,
+    stream=False,
+    optimize=False,
+    prune=False,
+    jobs=None,
+    cache_dir=None,
+    costs=None,
+    **options,
+):
+    """
+    optimize runs vm_peephole over the commands of each file before code
+    generation, and prune leaves out the functions that Sys.init never calls,
+    directly or indirectly. With jobs, files are translated independently in
+    that many processes, and with cache_dir their fragments are also cached
+    there. costs is a path to write the per-function cost report to; options
+    are passed on to the CodeWriter.
+    """
     directory_name = re.findall(r"\w+", path)[-1]
     file_paths = [
         os.path.join(path, file) for file in os.listdir(path) if file.endswith(".vm")
     ]
 
-    ps = [Parser(file_path) for file_path in file_paths]
-    file_names = [re.findall(r"\w+", file_path)[-2] for file_path in file_paths]
+    dead = []
+    if prune:
+        dead = unreachable_functions(call_graph(file_paths))
+    dead_set = frozenset(dead)
 
-    cw = CodeWriter()
-    if not skip_bootstrap:
-        cw.writeInit()
-    for p, file_name in zip(ps, file_names):
-        cw.setFileName(file_name=file_name)
+    cw = CodeWriter(**options)
+    rewrites = Counter()
+    if cache_dir is not None and jobs is None:
+        jobs = 1
+    if jobs is not None:
+        lines = translate_parallel(
+            cw,
+            file_paths,
+            jobs,
+            options,
+            skip_bootstrap,
+            optimize=optimize,
+            rewrites=rewrites,
+            dead=dead_set,
+            cache_dir=cache_dir,
+        )
+        stream_to_disk(lines, file_path=os.path.join(path, directory_name + ".asm"))
+    elif stream:
+        lines = stream_files(
+            cw,
+            file_paths,
+            skip_bootstrap,
+            optimize=optimize,
+            rewrites=rewrites,
+            dead=dead_set,
+        )
+        stream_to_disk(lines, file_path=os.path.join(path, directory_name + ".asm"))
+    else:
+        file_names = [re.findall(r"\w+", file_path)[-2] for file_path in file_paths]
 
-        while True:
-            cmd = p.cmd.split()
-            cw.writeLine(*cmd)
-            if p.hasMoreCommands:
-                p.advance()
-            else:
-                break
-    cw.to_disk(file_path=(os.path.join(path, directory_name + ".asm")))
+        if not skip_bootstrap:
+            cw.writeInit()
+        for file_path, file_name in zip(file_paths, file_names):
+            cw.setFileName(file_name=file_name)
+            cw.writeProgram(read_commands(file_path, optimize, rewrites, dead_set))
+        cw.to_disk(file_path=(os.path.join(path, directory_name + ".asm")))
+
+    if costs is not None:
+        report_costs(os.path.join(path, directory_name + ".asm"), costs)
+    if dead:
+        print(f"Dropped {len(dead)} unreachable functions:")
+        for function_name in dead:
+            print(f"  {function_name}")
+    report_rewrites(rewrites)
+    for line in cw.report():
+        print(line)
 
 
 if __name__ == "__main__":
@@ -241,13 +1104,96 @@ if __name__ == "__main__":
     # Required positional argument
     parser.add_argument("path", help="path to asm file")
     parser.add_argument("-s", "--skip-bootstrap", action="store_true", default=False)
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="write assembly as it is generated instead of all at the end",
+    )
+    parser.add_argument(
+        "-t",
+        "--trampolines",
+        action="store_true",
+        default=False,
+        help="share one call routine and one return routine across the program",
+    )
+    parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        default=False,
+        help="rewrite common command sequences into fused commands first",
+    )
+    parser.add_argument(
+        "-p",
+        "--prune",
+        action="store_true",
+        default=False,
+        help="leave out functions that Sys.init never calls (directories only)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="translate the files of a directory in this many processes",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="reuse the fragments of unchanged files, cached in <path>/.vmcache",
+    )
+    parser.add_argument(
+        "--costs",
+        help="write ROM words and estimated cycles per function to this .json "
+        "or .csv file",
+    )
+    parser.add_argument(
+        "-z",
+        "--zero-fill",
+        action="store_true",
+        default=False,
+        help="zero locals with a compact sequence or a shared routine",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache-tos",
+        action="store_true",
+        default=False,
+        help="keep the top of the stack in D between commands where possible",
+    )
 
     args = parser.parse_args()
+    if (args.jobs is not None or args.incremental) and args.stream:
+        parser.error("--stream cannot be combined with -j/--jobs or -i")
 
     path = args.path
     skip_bootstrap = args.skip_bootstrap
+    options = dict(
+        trampolines=args.trampolines,
+        cache_tos=args.cache_tos,
+        zero_fill=args.zero_fill,
+    )
 
     if os.path.isdir(path):
-        translate_directory(path=path, skip_bootstrap=skip_bootstrap)
+        translate_directory(
+            path=path,
+            skip_bootstrap=skip_bootstrap,
+            stream=args.stream,
+            optimize=args.optimize,
+            prune=args.prune,
+            jobs=args.jobs,
+            cache_dir=os.path.join(path, ".vmcache") if args.incremental else None,
+            costs=args.costs,
+            **options,
+        )
     else:
-        translate_single_file(file_path=path, skip_bootstrap=skip_bootstrap)
+        translate_single_file(
+            file_path=path,
+            skip_bootstrap=skip_bootstrap,
+            stream=args.stream,
+            optimize=args.optimize,
+            costs=args.costs,
+            **options,
+        )